@@ -28,8 +28,23 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
-import json
+# Prefer the faster JSON parsers if they happen to be installed -- both
+# are drop-in replacements for the parsing that ampy does
+try:
+    import orjson as json
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
+import importlib
 import operator
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
 
 from libampy.ampmesh import AmpMesh
 from libampy.viewmanager import ViewManager
@@ -40,19 +55,107 @@ from libampy.asnnames import ASNManager
 
 from libnntscclient.logger import *
 
-from libampy.collections.ampicmp import AmpIcmp
-from libampy.collections.amptraceroute import AmpTraceroute, AmpAsTraceroute
-from libampy.collections.amptraceroute import AmpTraceroutePathlen
-from libampy.collections.ampdns import AmpDns
-from libampy.collections.amphttp import AmpHttp
-from libampy.collections.amptcpping import AmpTcpping
-from libampy.collections.ampthroughput import AmpThroughput
-from libampy.collections.ampudpstream import AmpUdpstream
-from libampy.collections.ampyoutube import AmpYoutube
-from libampy.collections.ampfastping import AmpFastping
-from libampy.collections.ampexternal import AmpExternal
-from libampy.collections.ampsip import AmpSip
-from libampy.collections.rrdsmokeping import RRDSmokeping
+def serialize(obj):
+    """
+    Serialises an ampy result structure to JSON using the fastest
+    encoder available.
+
+    Intended for web frontends that would otherwise feed our results
+    straight into the standard json encoder. Matrix view dictionaries
+    are keyed by (source, destination) tuples, which JSON cannot
+    represent, so tuple keys are flattened into "source|destination"
+    strings first; site names cannot contain '|' so the mapping is
+    unambiguous.
+
+    Returns the encoded JSON -- as bytes if orjson is doing the
+    encoding, otherwise as a string.
+    """
+    obj = _jsonable(obj)
+    if hasattr(json, "OPT_NON_STR_KEYS"):
+        # orjson refuses non-string keys (e.g. ints) unless told otherwise
+        return json.dumps(obj, option=json.OPT_NON_STR_KEYS)
+    return json.dumps(obj)
+
+def _jsonable(obj):
+    """
+    Recursively rewrites tuple dictionary keys so that the structure
+    can be handed to a JSON encoder.
+    """
+    if isinstance(obj, dict):
+        newdict = {}
+        for key, value in obj.items():
+            if isinstance(key, tuple):
+                key = "|".join(str(part) for part in key)
+            newdict[key] = _jsonable(value)
+        return newdict
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(item) for item in obj]
+    return obj
+
+# Number of seconds to remember view to group mappings in-process,
+# saving us a memcache or views database round-trip for hot views
+VIEW_GROUP_MEMO_TTL = 30
+
+# Special "ASNs" that are never looked up in the AS name database
+_AS_SENTINELS = {
+    "-2": "RFC 1918",
+    "-1": "No response",
+    "0": "Unknown",
+    "Private": "Private Address Space",
+}
+
+# How long to remember event group query results. Dashboards from many
+# browsers poll for the same groups at once, so even a few seconds of
+# memoisation collapses those into a single database query. Event group
+# time ranges are bucketed so that polls issued moments apart share an
+# entry despite their slightly different timestamps
+EVENT_GROUP_MEMO_TTL = 5
+EVENT_GROUP_TIME_BUCKET = 30
+EVENT_MEMBER_MEMO_TTL = 30
+
+# Number of seconds to remember translated tab rules. Translations can
+# consult the stream map, so don't remember them for longer than the
+# stream map refresh interval
+TAB_RULE_MEMO_TTL = 300
+
+# Maps each known collection name to the module and class implementing
+# it, plus whether the constructor takes the ASN manager. Collection
+# modules are imported on first use, so that processes which only ever
+# touch a handful of collections (or none at all, e.g. the event parser)
+# don't pay the import cost for the rest.
+_COLLECTION_CLASSES = {
+    'amp-icmp': ('libampy.collections.ampicmp', 'AmpIcmp', False),
+    'amp-astraceroute':
+        ('libampy.collections.amptraceroute', 'AmpAsTraceroute', True),
+    'amp-traceroute':
+        ('libampy.collections.amptraceroute', 'AmpTraceroute', True),
+    'amp-traceroute_pathlen':
+        ('libampy.collections.amptraceroute', 'AmpTraceroutePathlen', True),
+    'amp-dns': ('libampy.collections.ampdns', 'AmpDns', False),
+    'amp-http': ('libampy.collections.amphttp', 'AmpHttp', False),
+    'amp-tcpping': ('libampy.collections.amptcpping', 'AmpTcpping', False),
+    'amp-throughput':
+        ('libampy.collections.ampthroughput', 'AmpThroughput', False),
+    'amp-udpstream':
+        ('libampy.collections.ampudpstream', 'AmpUdpstream', False),
+    'amp-youtube': ('libampy.collections.ampyoutube', 'AmpYoutube', False),
+    'amp-fastping': ('libampy.collections.ampfastping', 'AmpFastping', False),
+    'amp-external': ('libampy.collections.ampexternal', 'AmpExternal', False),
+    'amp-sip': ('libampy.collections.ampsip', 'AmpSip', False),
+    'rrd-smokeping':
+        ('libampy.collections.rrdsmokeping', 'RRDSmokeping', False),
+}
+
+class _ColEntry(object):
+    """
+    Record tying a collection's NNTSC id to its (lazily instantiated)
+    collection module, so that _getcol can find both with one lookup.
+    """
+    __slots__ = ('colid', 'module')
+
+    def __init__(self, colid):
+        self.colid = colid
+        self.module = None
 
 class Ampy(object):
     """
@@ -145,7 +248,7 @@ class Ampy(object):
     """
 
     def __init__(self, ampdbconf, viewconf, nntscconf, eventconf,
-            asdbconf=None):
+            asdbconf=None, memcacheconf=None):
         """
         Init function for the Ampy class.
 
@@ -154,6 +257,13 @@ class Ampy(object):
           viewconf -- config for connecting to the Views database.
           nntscconf -- config for connecting to the NNTSC exporter.
           eventconf -- config for connecting to the Events database.
+          memcacheconf -- optional config for the memcached instance used
+                          for caching. May contain a 'servers' item: a
+                          list of memcached server addresses. If not
+                          provided, memcached on the local host is used.
+                          All workers pointed at the same memcached will
+                          share one cache, so identical NNTSC queries
+                          are only ever made once across the deployment.
 
         Refer to the AmpyDatabase class for more details on the
         configuration required for connecting to databases via ampy.
@@ -164,15 +274,24 @@ class Ampy(object):
         self.ampmesh = AmpMesh(ampdbconf)
         self.viewmanager = ViewManager(viewconf)
         self.nntscconfig = nntscconf
-        self.cache = AmpyCache(12)
+        if memcacheconf is not None and 'servers' in memcacheconf:
+            self.cache = AmpyCache(12, memcacheconf['servers'])
+        else:
+            self.cache = AmpyCache(12)
         self.eventmanager = EventManager(eventconf)
         self.asmanager = ASNManager(asdbconf, self.cache)
 
         self.collections = {}
-        self.savedcoldata = {}
+        self._collections_tuple = ()
         self.started = False
+        self._io_pool = None
+        self._viewgroup_memo = {}
+        self._tabrule_memo = {}
+        self._eventgroup_memo = {}
+        self._eventmember_memo = {}
+        self._legend_memo = {}
 
-    def start(self):
+    def start(self, preload=True):
         """
         Ensures ampy is ready for subsequent API calls by populating the
         internal list of available collections.
@@ -181,17 +300,32 @@ class Ampy(object):
         making any other API calls. start() only needs to be called once
         per Ampy instance.
 
+        Parameters:
+          preload -- if True, the module for each supported collection is
+                     instantiated now rather than on first use.
+
         Returns:
           None if the collection query fails, otherwise returns the number
           of supported collections.
         """
         # Only fetch the collections the first time this is called.
         if self.started:
-            return len(self.savedcoldata)
+            return len(self.collections)
 
+        self._viewgroup_memo.clear()
         retval = self._query_collections()
         if retval is None:
             return None
+
+        if preload:
+            # Instantiate the collection modules now so that the first
+            # request for each collection doesn't have to wear the
+            # construction cost. Stream maps are still fetched on demand.
+            # Collections that NNTSC supports but ampy has no module for
+            # will log a warning here instead of on first request.
+            for colname in self.collections:
+                self._getcol(colname, updatestreams=False)
+
         self.started = True
         return retval
 
@@ -200,9 +334,9 @@ class Ampy(object):
         Fetches a list of collections available via this Ampy instance.
 
         Returns:
-          a list of collection names
+          a sequence of collection names
         """
-        return list(self.savedcoldata.keys())
+        return self._collections_tuple
 
     def get_meshes(self, endpoint, amptest=None, site=None, public=None):
         """
@@ -246,12 +380,18 @@ class Ampy(object):
           the second is the list of targets.
           Returns None if the query fails.
         """
-        sources = self.ampmesh.get_mesh_sources(sourcemesh)
-        if sources is None:
-            return None
+        # The two mesh queries are independent, so issue them both to
+        # the worker pool at once. The gain is bounded by AmpMesh
+        # serialising queries on its single database connection, but any
+        # time spent outside that lock is overlapped.
+        pool = self._get_io_pool(2)
+        srcfuture = pool.submit(self.ampmesh.get_mesh_sources, sourcemesh)
+        destfuture = pool.submit(self.ampmesh.get_mesh_destinations, destmesh)
+
+        sources = srcfuture.result()
+        dests = destfuture.result()
 
-        dests = self.ampmesh.get_mesh_destinations(destmesh)
-        if dests is None:
+        if sources is None or dests is None:
             return None
 
         return (sources, dests)
@@ -461,9 +601,6 @@ class Ampy(object):
           timeout.
 
         """
-        recentdata = {}
-        timeouts = []
-
         # Most of the work here is finding all of the labels for the
         # view we're given.
         viewgroups = self._view_to_groups(viewstyle, view_id)
@@ -471,26 +608,45 @@ class Ampy(object):
             log("Failed to fetch recent data")
             return None
 
+        worklist = []
         for colname, vgs in viewgroups.items():
             col = self._getcol(colname)
             if col is None:
                 log("Failed to create collection module %s" % (colname))
                 return None
 
-            alllabels = []
-            for (gid, descr) in vgs:
-                grouplabels = col.group_to_labels(gid, descr, True)
-                if grouplabels is None:
-                    log("Unable to convert group %d into stream labels" % (gid))
-                    continue
-                alllabels += grouplabels
+            alllabels = col.groups_to_labels(vgs, True)
 
-            result = col.get_collection_recent(self.cache, alllabels,
-                    duration, detail)
+            worklist.append((colname, col, alllabels))
+
+        # The vast majority of views span a single collection, so skip
+        # the worker pool entirely for those. Multi-collection views
+        # have their queries dispatched concurrently, as each query is
+        # dominated by NNTSC round-trips. Each worker creates its own
+        # connection to NNTSC so the queries will not serialise inside
+        # the client.
+        if len(worklist) == 1:
+            colname, col, alllabels = worklist[0]
+            results = [col.get_collection_recent(self.cache, alllabels,
+                    duration, detail)]
+        else:
+            pool = self._get_io_pool(len(worklist))
+            futures = [pool.submit(col.get_collection_recent, self.cache,
+                    alllabels, duration, detail)
+                    for colname, col, alllabels in worklist]
+            results = [future.result() for future in as_completed(futures)]
 
-            if result is not None:
-                recentdata.update(result[0])
-                timeouts += result[1]
+        results = [result for result in results if result is not None]
+
+        # Hand back the sole result directly instead of copying it into
+        # a fresh dict; multi-collection results are merged in one pass
+        if len(results) == 1:
+            return results[0]
+
+        recentdata = {}
+        for result in results:
+            recentdata.update(result[0])
+        timeouts = list(chain.from_iterable(result[1] for result in results))
 
         return recentdata, timeouts
 
@@ -529,6 +685,7 @@ class Ampy(object):
             log("Failed to fetch historic data")
             return None
 
+        worklist = []
         for colname, vgs in viewgroups.items():
             col = self._getcol(colname)
             if col is None:
@@ -542,16 +699,28 @@ class Ampy(object):
                     description[gid]["collection"] = colname
 
             # Find all labels for this view and their corresponding streams
-            alllabels = []
-            for (gid, descr) in vgs:
-                grouplabels = col.group_to_labels(gid, descr, True)
-                if grouplabels is None:
-                    log("Unable to convert group %d into stream labels" % (gid))
-                    continue
-                alllabels += grouplabels
-            colhist = col.get_collection_history(self.cache, alllabels, start,
-                    end, detail, binsize)
+            alllabels = col.groups_to_labels(vgs, True)
 
+            worklist.append((colname, col, alllabels))
+
+        # As with get_recent_data, single-collection views are queried
+        # directly while multi-collection views are queried concurrently,
+        # as the total time is dominated by waiting on NNTSC responses
+        if len(worklist) == 1:
+            colname, col, alllabels = worklist[0]
+            colresults = [(colname, col.get_collection_history(self.cache,
+                    alllabels, start, end, detail, binsize))]
+        else:
+            pool = self._get_io_pool(len(worklist))
+            futures = {}
+            for colname, col, alllabels in worklist:
+                future = pool.submit(col.get_collection_history, self.cache,
+                        alllabels, start, end, detail, binsize)
+                futures[future] = colname
+            colresults = [(futures[future], future.result())
+                    for future in as_completed(futures)]
+
+        for colname, colhist in colresults:
             if colhist is None:
                 log("Error while fetching historical data for %s" % (colname))
                 return None
@@ -605,22 +774,17 @@ class Ampy(object):
         # For each entry, we also need a set of 'lines', one per group member
         nextlineid = 0
 
-        # Sort the groups in the view by collection then description.
-        # This ensures that A) the legend will be in a consistent order
-        # and B) the ordering is more obvious to the user (i.e. alphabetical
-        # starting with the first group property)
-        colkeys = list(viewgroups.keys())
-        colkeys.sort()
-
-        for colname in colkeys:
+        # The groups in the view are already sorted by collection then
+        # description (see _view_to_groups). This ensures that A) the
+        # legend will be in a consistent order and B) the ordering is more
+        # obvious to the user (i.e. alphabetical starting with the first
+        # group property)
+        for colname, colgroups in viewgroups.items():
             col = self._getcol(colname)
             if col is None:
                 log("Failed to create collection module %s" % (colname))
                 return None
 
-            colgroups = viewgroups[colname]
-            colgroups = sorted(colgroups, key=operator.itemgetter(1))
-
             for gid, descr in colgroups:
                 added = self._add_legend_item(legend, col, gid, descr, \
                         nextlineid)
@@ -755,37 +919,43 @@ class Ampy(object):
 
         maxgroups = tabcol.get_maximum_view_groups()
 
-        totalgroups = 0
-        matched = 0
-
+        # Don't allow switching to a view which cannot show this many
+        # groups. The total is known up front, so check it before doing
+        # any translation work.
+        totalgroups = sum(len(vgs) for vgs in groups.values())
+        if totalgroups > maxgroups:
+            return False
+
+        # Translate every group first, discarding duplicates -- groups
+        # within a view often translate to the same rule for the target
+        # collection. The target collection has already been fetched, so
+        # reuse it if the view also contains groups from it.
+        cols = {tabcollection: tabcol}
+        tabrules = []
+        seenrules = set()
         for colname, vgs in groups.items():
-            col = self._getcol(colname)
+            col = cols.get(colname)
             if col is None:
-                log("Error while getting original collection %s" % (colname))
-                return None
+                col = self._getcol(colname)
+                if col is None:
+                    log("Error while getting original collection %s" % \
+                            (colname))
+                    return None
+                cols[colname] = col
 
             for gid, descr in vgs:
-                # Don't allow switching to a view which can only show 1 group
-                totalgroups += 1
-                if totalgroups > maxgroups:
-                    return False
-
-                # Translate each group in turn
-                grouprule = col.parse_group_description(descr)
-
-                tabrule = tabcol.translate_group(grouprule)
-                if tabrule is None:
+                tabrule = self._translate_tab_rule(col, tabcol, descr)
+                if tabrule is None or tabrule in seenrules:
                     continue
+                seenrules.add(tabrule)
+                tabrules.append(tabrule)
 
-                labels = tabcol.group_to_labels('tabcheck', tabrule, True)
-                for lab in labels:
-                    # We can bail as soon as we get one group with a stream
-                    if len(lab['streams']) > 0:
-                        matched += 1
-                        break
-
-        if matched == len(groups):
-            return True
+        # Resolve the candidate rules one at a time so we can bail on the
+        # first rule with a matching stream, without resolving the rest
+        for tabrule in tabrules:
+            for lab in tabcol.group_to_labels('tabcheck', tabrule, True):
+                if lab['streams']:
+                    return True
 
         # If we get here, none of the translated groups would match any
         # streams in the database
@@ -835,27 +1005,37 @@ class Ampy(object):
             log("Error while constructing tabview")
             return None
 
-        # Translate each group in turn
-        tabgroups = set()
+        # Translate each group in turn, then resolve all of the resulting
+        # rules to group IDs with one batched query rather than one
+        # round-trip per rule. As above, reuse the already-fetched target
+        # collection where possible.
+        cols = {tabcollection: tabcol}
+        tabrules = []
+        seenrules = set()
 
         for colname, vgs in groups.items():
-            col = self._getcol(colname)
+            col = cols.get(colname)
             if col is None:
-                log("Error while getting original collection %s" % (colname))
-                return None
+                col = self._getcol(colname)
+                if col is None:
+                    log("Error while getting original collection %s" % \
+                            (colname))
+                    return None
+                cols[colname] = col
 
             for gid, descr in vgs:
-                grouprule = col.parse_group_description(descr)
-
-                tabrule = tabcol.translate_group(grouprule)
-                if tabrule is None:
+                tabrule = self._translate_tab_rule(col, tabcol, descr)
+                if tabrule is None or tabrule in seenrules:
                     continue
+                seenrules.add(tabrule)
+                tabrules.append(tabrule)
 
-                tabid = self.viewmanager.get_group_id(tabcollection, tabrule)
-                if tabid is None:
-                    continue
+        tabids = self.viewmanager.get_group_ids(tabcollection, tabrules)
+        if tabids is None:
+            tabids = {}
 
-                tabgroups.add(tabid)
+        # View groups should always be in sorted order
+        tabgroups = sorted(tabids.values())
 
         # If no groups were successfully translated to the new collection,
         # bail as we have nothing to draw on the graph.
@@ -869,10 +1049,6 @@ class Ampy(object):
             log("No valid groups were found for new tab")
             return None
 
-        # View groups should always be in sorted order
-        tabgroups = list(tabgroups)
-        tabgroups.sort()
-
         # Create ourselves a new view
         tabview = self.viewmanager.get_view_id(tabcol.viewstyle, \
                 tabgroups)
@@ -922,11 +1098,13 @@ class Ampy(object):
 
         """
 
-        # Check if we have a cache entry for this stream
+        # Check if we have a cache entry for this stream. As with the
+        # view group cache, don't write the entry back just to refresh
+        # its timeout -- popular streams are simply re-stored when their
+        # entries expire, and skipping the write halves the cache
+        # traffic for this endpoint
         cachedview = self.cache.search_stream_view(stream)
         if cachedview is not None:
-            # Reset the cache timeout
-            self.cache.store_stream_view(stream, cachedview)
             return cachedview
 
         if collection == "amp-latency":
@@ -934,17 +1112,7 @@ class Ampy(object):
         else:
             possibles = [collection]
 
-        streamprops = None
-        for c in possibles:
-            col = self._getcol(c)
-            if col is None:
-                continue
-
-            # Find the stream in our stream hierarchy
-            streamprops = col.find_stream(stream)
-            if streamprops is not None:
-                collection = c
-                break
+        found, col, streamprops = self._find_stream_in_any(possibles, stream)
 
         if streamprops is None:
             log("Error while creating event view")
@@ -952,6 +1120,8 @@ class Ampy(object):
                     (stream, collection))
             return None
 
+        collection = found
+
         # Convert the stream properties into a group description that we can
         # use to create a view. Note that the group may include other streams
         # in addition to the one we are looking for -- this is intentional.
@@ -1013,12 +1183,9 @@ class Ampy(object):
             # Allow options to be specified as a list or a dictionary. The
             # list format requires knowledge of special formatting for some
             # fields (e.g. DNS flags) that other code doesn't know about.
-            # Using create_group_description() lets the collection specific
-            # code do all the formatting work for us.
-            if isinstance(options, dict):
-                newgroup = col.create_group_description(options)
-            else:
-                newgroup = col.create_group_from_list(options)
+            # create_group() lets the collection specific code do all of
+            # the formatting work for us.
+            newgroup = col.create_group(options)
             if newgroup is None:
                 return view_id
 
@@ -1115,26 +1282,57 @@ class Ampy(object):
         # Convert our view groups into a set of stream labels. In particular,
         # we will need the list of streams for each label as the events are
         # associated with stream IDs, not labels or groups or views.
-        alllabels = []
-
+        worklist = []
         for colname, vgs in groups.items():
             col = self._getcol(colname)
             if col is None:
                 log("Error while creating module for collection %s" % (colname))
                 return None
 
-            for gid, descr in vgs:
-                grouplabels = col.group_to_labels(gid, descr, True)
-                if grouplabels is None:
-                    log("Unable to convert group %d into stream labels" % (gid))
-                    continue
+            worklist.append((col, vgs))
 
-                for gl in grouplabels:
-                    gl['groupid'] = gid
-                alllabels += grouplabels
+        # As with the data fetching functions, only bother the worker
+        # pool if the view genuinely spans multiple collections
+        if len(worklist) == 1:
+            col, vgs = worklist[0]
+            alllabels = self._event_view_labels(col, vgs)
+        else:
+            pool = self._get_io_pool(len(worklist))
+            futures = [pool.submit(self._event_view_labels, col, vgs)
+                    for col, vgs in worklist]
+            alllabels = list(chain.from_iterable(
+                    future.result() for future in futures))
 
         return self.eventmanager.fetch_events(alllabels, start, end)
 
+    def _event_view_labels(self, col, vgs):
+        """
+        Builds the stream labels for one collection's worth of view
+        groups, tagging each label with the group that it came from.
+
+        Parameters:
+          col -- the collection module that the groups belong to.
+          vgs -- a list of (group id, group description) tuples.
+
+        Returns:
+          a list of stream labels. Groups that could not be converted to
+          labels are logged and skipped.
+        """
+        chunks = []
+        for gid, descr in vgs:
+            grouplabels = col.group_to_labels(gid, descr, True)
+            if grouplabels is None:
+                log("Unable to convert group %d into stream labels" % (gid))
+                continue
+
+            for gl in grouplabels:
+                gl['groupid'] = gid
+            chunks.append(grouplabels)
+
+        # Flatten once at the end, rather than repeatedly resizing a
+        # single list as each group's labels arrive
+        return list(chain.from_iterable(chunks))
+
     def get_single_event(self, stream, eventid):
         """
         Finds the event that matches the given stream ID and event ID.
@@ -1164,7 +1362,20 @@ class Ampy(object):
           a list of event groups or None if an error occurs while querying
           the event database.
         """
-        return self.eventmanager.fetch_groups(start, end)
+        memokey = (start // EVENT_GROUP_TIME_BUCKET,
+                end // EVENT_GROUP_TIME_BUCKET)
+        memoent = self._eventgroup_memo.get(memokey)
+        now = time.monotonic()
+        if memoent is not None and now - memoent[1] < EVENT_GROUP_MEMO_TTL:
+            return memoent[0]
+
+        groups = self.eventmanager.fetch_groups(start, end)
+        if groups is not None:
+            if len(self._eventgroup_memo) >= 256:
+                self._eventgroup_memo.clear()
+            self._eventgroup_memo[memokey] = (groups, now)
+
+        return groups
 
     def get_event_group_members(self, eventgroupid):
         """
@@ -1180,7 +1391,17 @@ class Ampy(object):
           a list of events or None if there was an error while querying
           the event database.
         """
+        memoent = self._eventmember_memo.get(eventgroupid)
+        now = time.monotonic()
+        if memoent is not None and now - memoent[1] < EVENT_MEMBER_MEMO_TTL:
+            return memoent[0]
+
         members = self.eventmanager.fetch_event_group_members(eventgroupid)
+        if members is not None:
+            if len(self._eventmember_memo) >= 1024:
+                self._eventmember_memo.clear()
+            self._eventmember_memo[eventgroupid] = (members, now)
+
         return members
 
 
@@ -1197,32 +1418,31 @@ class Ampy(object):
           lookup fails.
         """
         result = {}
-        toquery = set()
-        for a in asns:
-            if a == "-2":
-                asname = "RFC 1918"
-            elif a == "-1":
-                asname = "No response"
-            elif a == "0":
-                asname = "Unknown"
-            elif a == "Private":
-                asname = "Private Address Space"
+
+        # Dedupe the input up front -- per-hop traceroute lookups tend
+        # to repeat the same ASN many times
+        lookups = {}
+        for a in set(asns):
+            sentinel = _AS_SENTINELS.get(a)
+            if sentinel is not None:
+                result[a] = sentinel
             else:
-                aslabel = "AS" + a
-                asname = self.cache.search_asname(aslabel)
-                if asname is None:
-                    toquery.add(aslabel)
+                lookups["AS" + a] = a
 
-            if asname is not None:
-                result[a] = asname
+        # Check the cache for everything else with one bulk lookup,
+        # rather than paying a memcached round-trip per ASN
+        cached = self.cache.search_asnames(lookups.keys())
+        for aslabel, asname in cached.items():
+            result[lookups[aslabel]] = asname
+
+        toquery = set(lookups) - set(cached)
 
         queried = self.asmanager.queryASNames(toquery)
 
         if queried is None:
             return None
 
-        for a, n in queried.items():
-            result[a] = n
+        result.update(queried)
         return result
 
     def get_matching_asns(self, pageindex=1, pagesize=30, term=""):
@@ -1377,10 +1597,13 @@ class Ampy(object):
             # does the eventmanager so we need to query for it here. An empty
             # email address will prevent alerts from being sent.
             email = None
-            filter_ = json.loads(filterstring)
-            if "email" in filter_:
+            # Check the raw string before parsing anything -- most filter
+            # updates are toggling unrelated fields, in which case there
+            # is no need to parse the JSON or query for the user's address
+            if '"email"' in filterstring:
+                filter_ = json.loads(filterstring)
                 # True or False to enable/disable email alerting
-                if filter_["email"]:
+                if filter_.get("email"):
                     user = self.viewmanager.get_user(username)
                     if user and user["email"]:
                         email = user["email"]
@@ -1391,6 +1614,25 @@ class Ampy(object):
         return None
 
 
+    def _get_io_pool(self, workers):
+        """
+        Fetches the thread pool used to dispatch per-collection queries
+        concurrently, creating the pool if this is the first request to
+        use it.
+
+        Parameters:
+          workers -- the number of tasks that the caller is intending to
+                     submit to the pool.
+
+        Returns:
+          a ThreadPoolExecutor instance.
+        """
+        if self._io_pool is None:
+            # Make sure the pool is big enough to cover a view that
+            # spans every possible latency collection
+            self._io_pool = ThreadPoolExecutor(max_workers=max(workers, 4))
+        return self._io_pool
+
     def _query_collections(self):
         """
         Fetches the set of available collections from NNTSC and updates
@@ -1408,10 +1650,20 @@ class Ampy(object):
             return None
 
         for col in collections:
-            name = col['module'] + "-" + col['modsubtype']
-            self.savedcoldata[name] = col['id']
+            # Interned names make the dict lookups that every API call
+            # funnels through a pointer comparison rather than a string
+            # compare
+            name = sys.intern(col['module'] + "-" + col['modsubtype'])
+            if name in self.collections:
+                self.collections[name].colid = col['id']
+            else:
+                self.collections[name] = _ColEntry(col['id'])
 
-        return len(list(self.savedcoldata.keys()))
+        # get_collections hands this out on every page render, so build
+        # it once here rather than allocating a fresh list per call
+        self._collections_tuple = tuple(self.collections)
+
+        return len(self.collections)
 
     def _getcol(self, collection, updatestreams=True):
         """
@@ -1419,8 +1671,9 @@ class Ampy(object):
         name. If this Ampy instance does not have an instance of that
         collection module, one is created.
 
-        When adding new collection modules, this function needs to be
-        updated to ensure that Ampy will be able to utilise the new module.
+        When adding new collection modules, _COLLECTION_CLASSES needs to
+        be updated to ensure that Ampy will be able to utilise the new
+        module.
 
         Parameters:
           collection -- the name of the collection required.
@@ -1430,12 +1683,17 @@ class Ampy(object):
           None if the name does not match any known collections.
 
         """
-        newcol = None
         # If we have a matching collection, return that otherwise create a
-        # new instance of the collection
+        # new instance of the collection. Collection names arrive from
+        # user requests, so intern them to match the interned dict keys
+        entry = self.collections.get(sys.intern(collection))
+        if entry is None:
+            log("Collection type %s does not exist in NNTSC database" % \
+                    (collection))
+            return None
 
-        if collection in self.collections:
-            col = self.collections[collection]
+        if entry.module is not None:
+            col = entry.module
             if updatestreams:
                 if col.update_streams() is None:
                     log("Failed to update stream map for collection %s" % \
@@ -1443,46 +1701,21 @@ class Ampy(object):
                     return None
             return col
 
-        if collection not in self.savedcoldata:
-            log("Collection type %s does not exist in NNTSC database" % \
-                    (collection))
-            return None
-
-        colid = self.savedcoldata[collection]
-        if collection == "amp-icmp":
-            newcol = AmpIcmp(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-astraceroute":
-            newcol = AmpAsTraceroute(colid, self.viewmanager, self.nntscconfig, self.asmanager)
-        if collection == "amp-traceroute":
-            newcol = AmpTraceroute(colid, self.viewmanager, self.nntscconfig, self.asmanager)
-        if collection == "amp-traceroute_pathlen":
-            newcol = AmpTraceroutePathlen(colid, self.viewmanager, self.nntscconfig, self.asmanager)
-        if collection == "amp-dns":
-            newcol = AmpDns(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-http":
-            newcol = AmpHttp(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-tcpping":
-            newcol = AmpTcpping(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-throughput":
-            newcol = AmpThroughput(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-udpstream":
-            newcol = AmpUdpstream(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-youtube":
-            newcol = AmpYoutube(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-fastping":
-            newcol = AmpFastping(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-external":
-            newcol = AmpExternal(colid, self.viewmanager, self.nntscconfig)
-        if collection == "amp-sip":
-            newcol = AmpSip(colid, self.viewmanager, self.nntscconfig)
-        if collection == "rrd-smokeping":
-            newcol = RRDSmokeping(colid, self.viewmanager, self.nntscconfig)
-
-        if newcol is None:
+        known = _COLLECTION_CLASSES.get(collection)
+        if known is None:
             log("Unknown collection type: %s" % (collection))
             return None
 
-        self.collections[collection] = newcol
+        modname, classname, needsasns = known
+        colclass = getattr(importlib.import_module(modname), classname)
+
+        if needsasns:
+            newcol = colclass(entry.colid, self.viewmanager, self.nntscconfig,
+                    self.asmanager)
+        else:
+            newcol = colclass(entry.colid, self.viewmanager, self.nntscconfig)
+
+        entry.module = newcol
 
         if updatestreams:
             if newcol.update_streams() is None:
@@ -1492,6 +1725,80 @@ class Ampy(object):
 
         return newcol
 
+    def _find_stream_in_any(self, possibles, stream):
+        """
+        Searches a list of candidate collections for a stream, returning
+        the first collection that knows about it.
+
+        Candidates whose stream maps are already loaded are checked
+        first, as finding the stream in those is a purely local lookup.
+        Only if none of them recognise the stream do we pay to fetch the
+        stream maps for the remaining candidates.
+
+        Parameters:
+          possibles -- a list of candidate collection names.
+          stream -- the ID of the stream to search for.
+
+        Returns:
+          a tuple (collection name, collection module, stream properties)
+          for the first matching candidate, or (None, None, None) if no
+          candidate collection contains the stream.
+        """
+        loaded = []
+        unloaded = []
+        for c in possibles:
+            entry = self.collections.get(c)
+            if entry is not None and entry.module is not None and \
+                    entry.module.lastchecked > 0:
+                loaded.append(c)
+            else:
+                unloaded.append(c)
+
+        for c in loaded + unloaded:
+            col = self._getcol(c)
+            if col is None:
+                continue
+
+            # Find the stream in our stream hierarchy
+            streamprops = col.find_stream(stream)
+            if streamprops is not None:
+                return c, col, streamprops
+
+        return None, None, None
+
+    def _translate_tab_rule(self, col, tabcol, descr):
+        """
+        Translates a group description from one collection into a group
+        rule for a tab collection, remembering recent translations.
+
+        Every graph page tests the same view groups against the same
+        handful of tab collections, and translation can involve stream
+        map lookups, so the results are well worth memoising for a short
+        while.
+
+        Parameters:
+          col -- the collection module that the description belongs to.
+          tabcol -- the collection module to translate the group to.
+          descr -- the group description string to translate.
+
+        Returns:
+          the translated group rule, or None if the description has no
+          equivalent in the tab collection.
+        """
+        memokey = (col.collection_name, tabcol.collection_name, descr)
+        memoent = self._tabrule_memo.get(memokey)
+        now = time.monotonic()
+        if memoent is not None and now - memoent[1] < TAB_RULE_MEMO_TTL:
+            return memoent[0]
+
+        tabrule = tabcol.translate_group(col.parse_group_description(descr))
+
+        if len(self._tabrule_memo) >= 4096:
+            self._tabrule_memo.clear()
+        self._tabrule_memo[memokey] = (tabrule, now)
+
+        return tabrule
+
     def _view_to_groups(self, viewstyle, view_id):
         """
         Internal utility function that finds the set of view groups for
@@ -1507,17 +1814,36 @@ class Ampy(object):
         Returns:
           A dictionary of groups for the view, keyed by the collection
           that the group belongs to. The values are a tuple containing
-          the group ID and the string describing the group.
+          the group ID and the string describing the group. The
+          dictionary is ordered by collection name and each group list
+          is sorted by group description.
 
           Returns None if any of the steps undertaken during this
           function fails.
         """
 
-        # Check if the groups are in the cache
-        cachedgroups = self.cache.search_view_groups(view_id)
+        # Check our short-lived in-process memo first -- the same view is
+        # often requested several times in quick succession when a
+        # dashboard is drawn, so don't bother memcache or the views
+        # database in that case
+        memokey = (viewstyle, view_id)
+        memoent = self._viewgroup_memo.get(memokey)
+        now = time.monotonic()
+        if memoent is not None and now - memoent[1] < VIEW_GROUP_MEMO_TTL:
+            return memoent[0]
+
+        # Entries are so small that we are unlikely to ever hit this
+        # limit, but make sure the memo cannot grow without bound anyway
+        if len(self._viewgroup_memo) >= 1024:
+            self._viewgroup_memo.clear()
+
+        # Check if the groups are in the cache. There is no need to
+        # refresh the cache timeout on a hit; popular views will be
+        # re-stored naturally when their entries eventually expire
+        cachedgroups = self.cache.search_view_groups(viewstyle, view_id)
         if cachedgroups is not None:
-            # Refresh the cache timeout
-            self.cache.store_view_groups(view_id, cachedgroups)
+            cachedgroups = self._sort_view_groups(cachedgroups)
+            self._viewgroup_memo[memokey] = (cachedgroups, now)
             return cachedgroups
 
 
@@ -1528,13 +1854,34 @@ class Ampy(object):
                     (view_id, viewstyle))
             return None
 
+        viewgroups = self._sort_view_groups(viewgroups)
 
         # Put these groups in the cache
         if len(viewgroups) > 0:
-            self.cache.store_view_groups(view_id, viewgroups)
+            self.cache.store_view_groups(viewstyle, view_id, viewgroups)
+            self._viewgroup_memo[memokey] = (viewgroups, now)
 
         return viewgroups
 
+    def _sort_view_groups(self, viewgroups):
+        """
+        Sorts a view group dictionary by collection name, with each
+        collection's groups sorted by group description.
+
+        Sorting once here (and sharing the result via the view group
+        memo) means consumers that need a consistent ordering, such as
+        get_view_legend, never have to re-sort per call.
+
+        Parameters:
+          viewgroups -- a view group dictionary, as returned by the
+                        get_view_groups() function in ViewManager.
+
+        Returns:
+          the sorted view group dictionary.
+        """
+        return {colname: sorted(viewgroups[colname],
+                key=operator.itemgetter(1)) for colname in sorted(viewgroups)}
+
     def _get_matrix_groups(self, col, viewstyle, options):
         """
         Internal function for finding the groups necessary to populate
@@ -1572,11 +1919,10 @@ class Ampy(object):
             log("Invalid options for fetching matrix streams")
             return None
 
-        # Make sure we have an up-to-date list of streams before looking
-        # up any groups
-        if col.update_streams() is None:
-            log("Error while fetching matrix streams")
-            return None
+        # No need to refresh the stream list here: _getcol has already
+        # done so when the collection module was fetched, and
+        # update_streams itself won't re-query NNTSC until the check
+        # frequency has elapsed anyway
 
         # First two options must be the source and destination meshes
         sourcemesh = options[0]
@@ -1609,10 +1955,8 @@ class Ampy(object):
         # Note that there may be more than one group per cell, e.g. one half
         # of the cell may show ipv4 streams and the other may show ipv6
         # streams.
-        for s in sources:
-            for d in destinations:
-                col.update_matrix_groups(self.cache, s, d, optdict, groups, views,
-                        self.viewmanager, viewstyle)
+        col.update_matrix_groups_bulk(self.cache, sources, destinations,
+                optdict, groups, views, self.viewmanager, viewstyle)
 
         return groups, sources, destinations, views
 
@@ -1631,16 +1975,34 @@ class Ampy(object):
           the number of entries added to the legend list
         """
 
+        # Parsing and formatting a group description is deterministic, so
+        # remember the result -- dashboards re-render the same legends on
+        # every refresh. Only the line ids vary between renders and those
+        # are assigned below, outside of the memoised portion.
+        memokey = (col.collection_name, gid, descr)
+        cached = self._legend_memo.get(memokey)
+
+        if cached is None:
+            legendtext, aggmethod = col.get_legend_label(descr)
+            if legendtext is None:
+                legendtext = "Unknown"
+
+            # Don't lookup the streams themselves if we can avoid it
+            grouplabels = col.group_to_labels(gid, descr, False)
+            if grouplabels is None:
+                log("Unable to convert group %d into stream labels" % (gid))
+                return 0
+
+            cached = (legendtext, aggmethod,
+                    tuple((gl['labelstring'], gl['shortlabel'])
+                        for gl in grouplabels))
+            if len(self._legend_memo) >= 1024:
+                self._legend_memo.clear()
+            self._legend_memo[memokey] = cached
+
+        legendtext, aggmethod, linelabels = cached
+
         added = 0
-        legendtext, aggmethod = col.get_legend_label(descr)
-        if legendtext is None:
-            legendtext = "Unknown"
-
-        # Don't lookup the streams themselves if we can avoid it
-        grouplabels = col.group_to_labels(gid, descr, False)
-        if grouplabels is None:
-            log("Unable to convert group %d into stream labels" % (gid))
-            return added
         lines = []
 
         # Yes, we could assign line ids within group_to_labels but
@@ -1649,8 +2011,8 @@ class Ampy(object):
         # but group_to_labels is also used for other purposes so it
         # is cleaner to do it here even if it means an extra iteration
         # over the grouplabels list.
-        for gl in grouplabels:
-            lines.append((gl['labelstring'], gl['shortlabel'], nextlineid))
+        for labelstring, shortlabel in linelabels:
+            lines.append((labelstring, shortlabel, nextlineid))
             nextlineid += 1
             added += 1
 
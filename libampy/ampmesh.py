@@ -34,6 +34,10 @@ from threading import Lock
 from libampy.database import AmpyDatabase
 from libnntscclient.logger import log
 
+# Number of seconds for which a mesh membership query result may be
+# reused before going back to the database
+MESH_MEMBER_CACHE_TTL = 60
+
 class AmpMesh(object):
     """
     Class for interacting with the AMP meta-data database.
@@ -79,6 +83,41 @@ class AmpMesh(object):
         self.db.connect(15, encoding="UTF8")
         self.dblock = Lock()
 
+        # Recent mesh membership results, keyed by (mesh, endpoint).
+        # A matrix fetch will ask for the same source and destination
+        # meshes on every refresh, so avoid hitting the database each
+        # time when the answer seldom changes
+        self._membercache = {}
+
+    def _cached_members(self, mesh, endpoint):
+        """
+        Returns a recently fetched membership list for a mesh, or None
+        if there is no sufficiently fresh result cached.
+        """
+        cached = self._membercache.get((mesh, endpoint))
+        if cached is None:
+            return None
+        members, fetched = cached
+        if time.monotonic() - fetched >= MESH_MEMBER_CACHE_TTL:
+            del self._membercache[(mesh, endpoint)]
+            return None
+        return list(members)
+
+    def _store_members(self, mesh, endpoint, members):
+        """
+        Remembers a mesh membership query result for later reuse.
+        """
+        if len(self._membercache) >= 64:
+            self._membercache.clear()
+        self._membercache[(mesh, endpoint)] = (list(members), time.monotonic())
+
+    def _flush_member_cache(self):
+        """
+        Discards all cached mesh membership results. Called whenever a
+        mesh or its membership is modified.
+        """
+        self._membercache.clear()
+
     def _meshquery(self, query, params, lock=True):
         """
         Performs a basic query for mesh members and returns a list of results.
@@ -118,11 +157,18 @@ class AmpMesh(object):
         Returns:
           a list of all sources belonging to the mesh
         """
+        cached = self._cached_members(mesh, "src")
+        if cached is not None:
+            return cached
+
         query = """ SELECT ampname FROM active_mesh_members WHERE
                     meshname=%s AND mesh_is_src = true ORDER BY ampname
                 """
         params = (mesh,)
-        return self._meshquery(query, params, lock)
+        sites = self._meshquery(query, params, lock)
+        if sites is not None:
+            self._store_members(mesh, "src", sites)
+        return sites
 
     def get_mesh_destinations(self, mesh):
         """
@@ -134,11 +180,18 @@ class AmpMesh(object):
         Returns:
           a list of all targets belonging to the mesh
         """
+        cached = self._cached_members(mesh, "dst")
+        if cached is not None:
+            return cached
+
         query = """ SELECT ampname FROM active_mesh_members WHERE
                     meshname=%s AND mesh_is_dst = true ORDER BY ampname
                 """
         params = (mesh,)
-        return self._meshquery(query, params)
+        sites = self._meshquery(query, params)
+        if sites is not None:
+            self._store_members(mesh, "dst", sites)
+        return sites
 
     def get_meshes(self, endpoint, amptest=None, site=None, public=None):
         """
@@ -316,48 +369,36 @@ class AmpMesh(object):
         # whether they can be a source or not, rather than meshes.
         # When this changes, update these queries to reflect that.
 
+        # The window function hands us the total number of matching sites
+        # in the same result set, saving a separate count query per page
         if issrc:
-            countquery = """ SELECT DISTINCT site_ampname AS ampname
-                    FROM site JOIN active_mesh_members ON
-                    site.site_ampname = active_mesh_members.ampname WHERE
-                    mesh_is_src = true AND site.site_ampname ILIKE %s """
-            epquery = """ SELECT DISTINCT site_ampname AS ampname
+            epquery = """ SELECT ampname, count(*) OVER () AS total FROM
+                    ( SELECT DISTINCT site_ampname AS ampname
                     FROM site JOIN active_mesh_members ON
                     site.site_ampname = active_mesh_members.ampname WHERE
-                    mesh_is_src = true AND site.site_ampname ILIKE %s
-                    ORDER BY ampname LIMIT %s OFFSET %s  """
+                    mesh_is_src = true AND site.site_ampname ILIKE %s )
+                    AS sites ORDER BY ampname LIMIT %s OFFSET %s  """
         else:
-            countquery = """ SELECT DISTINCT site_ampname AS ampname
+            epquery = """ SELECT ampname, count(*) OVER () AS total FROM
+                    ( SELECT DISTINCT site_ampname AS ampname
                     FROM site JOIN active_mesh_members ON
                     site.site_ampname = active_mesh_members.ampname WHERE
-                    mesh_is_dst = true AND site.site_ampname ILIKE %s """
-            epquery = """ SELECT DISTINCT site_ampname AS ampname
-                    FROM site JOIN active_mesh_members ON
-                    site.site_ampname = active_mesh_members.ampname WHERE
-                    mesh_is_dst = true AND site.site_ampname ILIKE %s
-                    ORDER BY ampname LIMIT %s OFFSET %s  """
+                    mesh_is_dst = true AND site.site_ampname ILIKE %s )
+                    AS sites ORDER BY ampname LIMIT %s OFFSET %s  """
 
 
         matched = []
-        params = ("%" + term + "%",)
-
-        self.dblock.acquire()
-        if self.db.executequery(countquery, params) == -1:
-            log("Error while querying for site counts")
-            self.dblock.release()
-            return 0, []
-
-        epcount = self.db.cursor.rowcount
-        self.db.closecursor()
-
+        epcount = 0
         params = ("%" + term + "%", pagesize, offset)
 
+        self.dblock.acquire()
         if self.db.executequery(epquery, params) == -1:
             log("Error while querying for sites")
             self.dblock.release()
             return 0, []
 
         for row in self.db.cursor:
+            epcount = row['total']
             matched.append({'id': row[0], 'text': row[0]})
             if len(matched) > pagesize:
                 break
@@ -687,6 +728,7 @@ class AmpMesh(object):
 
         self.db.closecursor()
         self.dblock.release()
+        self._flush_member_cache()
         return True
 
     def get_site_endpoints(self):
@@ -966,6 +1008,7 @@ class AmpMesh(object):
             return None
         self.db.closecursor()
         self.dblock.release()
+        self._flush_member_cache()
         return True
 
     def add_mesh(self, ampname, longname, description, public, issource):
@@ -1000,6 +1043,7 @@ class AmpMesh(object):
         count = self.db.cursor.rowcount
         self.db.closecursor()
         self.dblock.release()
+        self._flush_member_cache()
         return count > 0
 
     def update_site(self, ampname, longname, location, description):
@@ -1047,6 +1091,7 @@ class AmpMesh(object):
         count = self.db.cursor.rowcount
         self.db.closecursor()
         self.dblock.release()
+        self._flush_member_cache()
         return count > 0
 
     def add_mesh_member(self, meshname, ampname):
@@ -1077,6 +1122,7 @@ class AmpMesh(object):
             self._update_last_modified_schedule(schedule["id"])
 
         self.dblock.release()
+        self._flush_member_cache()
 
         return True
 
@@ -1100,6 +1146,7 @@ class AmpMesh(object):
             self._update_last_modified_schedule(schedule["id"])
 
         self.dblock.release()
+        self._flush_member_cache()
 
         return True
 
@@ -76,21 +76,11 @@ class ASNManager(object):
 
     def getASNsByName(self, pagesize=30, offset=0, term=""):
         # sanitize the term so we don't get sql-injected
-        query = """SELECT count(*) FROM asmap WHERE CAST(asn AS TEXT) ILIKE
-                %s OR asname ILIKE %s"""
-        params = ("%" + term + "%", "%" + term + "%")
-
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            self.dblock.release()
-            log("Error while counting ASNs in the database")
-            return (0, {})
-        ascount = self.db.cursor.fetchone()[0]
-        self.db.closecursor()
-        self.dblock.release()
-
-        query = """SELECT * FROM asmap WHERE CAST(asn AS TEXT) ILIKE
-                %s OR asname ILIKE %s ORDER BY asn LIMIT %s OFFSET %s"""
+        # The window function hands us the total number of matches in the
+        # same result set, saving a separate count query per page fetch
+        query = """SELECT asn, asname, count(*) OVER () AS total FROM asmap
+                WHERE CAST(asn AS TEXT) ILIKE %s OR asname ILIKE %s
+                ORDER BY asn LIMIT %s OFFSET %s"""
         params = ("%" + term + "%", "%" + term + "%", pagesize, offset)
 
         self.dblock.acquire()
@@ -99,8 +89,10 @@ class ASNManager(object):
             log("Error while querying for all AS names")
             return (0, {})
 
+        ascount = 0
         allasns = []
         for row in self.db.cursor:
+            ascount = row['total']
             asstring = "AS%s %s" % (row[0], row[1])
             allasns.append({'id': str(row[0]), 'text': asstring})
 
@@ -77,18 +77,25 @@ class AmpyCache(object):
         view ID.
     """
 
-    def __init__(self, blocksize):
+    def __init__(self, blocksize, servers=None):
         """
         Init function for the AmpyCache class.
 
         Parameters:
           blocksize -- the number of binned measurements to include in a
                        data block.
+          servers -- a list of memcached server addresses to use. If not
+                     provided, a memcached instance on the local host is
+                     assumed. Pointing every ampy user at the same
+                     memcached means the cache is shared across all web
+                     workers, even those on other hosts.
         """
 
         self.blocksize = blocksize
+        if servers is None:
+            servers = ["127.0.0.1"]
         self.memcache = pylibmc.Client(
-                ["127.0.0.1"],
+                servers,
                 behaviors={
                     "tcp_nodelay": True,
                     "no_block": True,
@@ -371,6 +378,30 @@ class AmpyCache(object):
         cachekey = self._asn_cache_key(aslabel)
         return self._cachefetch(cachekey, "AS name")
 
+    def search_asnames(self, aslabels):
+        """
+        Searches the cache for the AS names of multiple AS numbers using
+        a single bulk lookup.
+
+        Parameters:
+          aslabels -- a list of strings describing the ASNs to search for.
+
+        Returns:
+          a dictionary mapping each cached aslabel to its AS name. ASNs
+          that are not present in the cache are omitted from the result.
+        """
+        keymap = {self._asn_cache_key(a): a for a in aslabels}
+
+        fetched = {}
+        with self.mcpool.reserve() as mc:
+            try:
+                fetched = mc.get_multi(list(keymap.keys()))
+            except pylibmc.SomeErrors as e:
+                log("Warning: pylibmc error while bulk searching AS names")
+                log(e)
+
+        return {keymap[k]: v for k, v in fetched.items()}
+
     def store_asname(self, aslabel, asname):
         """
         Caches the AS name for an AS number.
@@ -431,11 +462,12 @@ class AmpyCache(object):
         cachekey = self._stream_view_cache_key(streamid)
         return self._cachefetch(cachekey, "stream view")
 
-    def store_view_groups(self, viewid, groups):
+    def store_view_groups(self, viewstyle, viewid, groups):
         """
         Caches the dictionary of groups that belong to a particular view.
 
         Parameters:
+          viewstyle -- the name of the view style the view belongs to.
           viewid -- the ID number of the view that the groups belong to.
           groups -- the dictionary of groups for the view, as returned by
                     the get_view_groups() function in the ViewManager class.
@@ -443,15 +475,16 @@ class AmpyCache(object):
         Returns:
           None
         """
-        cachekey = self._view_groups_cache_key(viewid)
+        cachekey = self._view_groups_cache_key(viewstyle, viewid)
         self._cachestore(cachekey, groups, self.viewgroups_cachetime,
                 "view groups")
 
-    def search_view_groups(self, viewid):
+    def search_view_groups(self, viewstyle, viewid):
         """
         Searches the cache for the groups that belong to a given view.
 
         Parameters:
+          viewstyle -- the name of the view style the view belongs to.
           viewid -- the ID number of the view to search for.
 
         Returns:
@@ -461,7 +494,7 @@ class AmpyCache(object):
         The returned dictionary matches the format returned by the
         get_view_groups() function in the ViewManager class.
         """
-        cachekey = self._view_groups_cache_key(viewid)
+        cachekey = self._view_groups_cache_key(viewstyle, viewid)
         return self._cachefetch(cachekey, "view groups")
 
     def store_matrix_view(self, label, viewid, cachetime):
@@ -475,6 +508,30 @@ class AmpyCache(object):
         cachekey = "matv_" + label
         return self._cachefetch(cachekey, "matrix view")
 
+    def search_matrix_views(self, labels):
+        """
+        Searches the cache for view ids matching multiple matrix cell
+        labels using a single bulk lookup.
+
+        Parameters:
+          labels -- a list of matrix cell labels to search for.
+
+        Returns:
+          a dictionary mapping each cached label to its view id. Labels
+          that are not present in the cache are omitted from the result.
+        """
+        keymap = {"matv_" + label: label for label in labels}
+
+        fetched = {}
+        with self.mcpool.reserve() as mc:
+            try:
+                fetched = mc.get_multi(list(keymap.keys()))
+            except pylibmc.SomeErrors as e:
+                log("Warning: pylibmc error while bulk searching matrix views")
+                log(e)
+
+        return {keymap[k]: v for k, v in fetched.items()}
+
     def _cachestore(self, key, data, cachetime, errorstr):
         """
         Internal helper function for storing a cache entry.
@@ -529,8 +586,8 @@ class AmpyCache(object):
     # Functions to construct cache keys for the various types of data that
     # we cache. Hopefully, they do not need a full explanation.
 
-    def _view_groups_cache_key(self, viewid):
-        return "viewgroups_%s" % (str(viewid))
+    def _view_groups_cache_key(self, viewstyle, viewid):
+        return "viewgroups_%s_%s" % (viewstyle, str(viewid))
 
     def _stream_view_cache_key(self, streamid):
         return "streamview_%s" % (str(streamid))
@@ -30,6 +30,8 @@
 
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, product
 from threading import Lock
 
 from libampy.nntsc import NNTSCConnection
@@ -60,6 +62,9 @@ class Collection(object):
     extra_blocks:
         Determines how many extra blocks should be fetched when making
         a data query.
+    create_group:
+        Converts either a dictionary or an ordered list of group
+        properties into an appropriate group description.
     create_group_from_list:
         Converts an ordered list of group properties into an appropriate
         group description for the collection.
@@ -87,6 +92,9 @@ class Collection(object):
         Converts a group description string into a set of labels describing
         each of the lines that would need to be drawn on a graph for that
         group.
+    groups_to_labels:
+        Converts a list of view groups into a single list of labels
+        covering every group in the list.
     format_single_data:
         Modifies a single queried data point into an appropriate format for
         display on a graph, e.g. converting byte counts into bitrates.
@@ -99,6 +107,8 @@ class Collection(object):
     update_matrix_groups:
         Finds all of the groups that need to queried to populate a matrix cell,
         including the stream ids of the group members.
+    update_matrix_groups_bulk:
+        Finds the groups required for every cell in a matrix at once.
     update_streams:
         Queries NNTSC for any new streams that have appeared since we last
         updated our local stream manager.
@@ -127,6 +137,21 @@ class Collection(object):
         self.collock = Lock()
         self.integerproperties = []
 
+        # The same group description strings are parsed over and over
+        # again (legend labels, stream labels, tab views, ...), so wrap
+        # the collection-specific parser with a small memo to avoid
+        # re-running its regex on every call. Binding the wrapper here
+        # picks up the child collection's implementation.
+        self._groupparsecache = {}
+        self._parse_group_uncached = self.parse_group_description
+        self.parse_group_description = self._parse_group_cached
+
+        # Compiled group description regexes, keyed by the pattern string
+        self._compiledregexes = {}
+
+        # Thread pool for matrix cell updates, created on first use
+        self._matrix_pool = None
+
         # These members MUST be overridden by the child collection's init
         # function
         self.collection_name = "basecollection"
@@ -217,6 +242,30 @@ class Collection(object):
 
         return binsize
 
+    def create_group(self, options):
+        """
+        Converts a set of group properties into a group description
+        string, accepting either a property dictionary or an ordered
+        property list.
+
+        This saves callers that receive properties in either shape (e.g.
+        the web API) from having to pick between
+        create_group_description and create_group_from_list themselves.
+
+        Parameters:
+          options -- either a dictionary of group properties or a list of
+                     property values ordered to match the collection's
+                     groupproperties list.
+
+        Returns:
+          a string describing the group or None if no string can be
+          formed using the provided properties
+        """
+
+        if isinstance(options, dict):
+            return self.create_group_description(options)
+        return self.create_group_from_list(options)
+
     def create_group_from_list(self, options):
         """
         Converts an ordered list of group properties into a suitable group
@@ -315,6 +364,36 @@ class Collection(object):
 
         return None
 
+    def _parse_group_cached(self, description):
+        """
+        Caching wrapper around parse_group_description.
+
+        Group descriptions never change once created, so the parsed form
+        can be remembered across calls and requests. Callers are known to
+        modify the dictionary that we give them, so they always receive a
+        shallow copy of the cached entry rather than the original.
+
+        Parameters:
+          description -- the group description string to be converted
+
+        Returns:
+          a dictionary of group properties or None if the string does
+          not match the correct format for the collection.
+        """
+        cached = self._groupparsecache.get(description)
+        if cached is None:
+            cached = self._parse_group_uncached(description)
+            if cached is None:
+                return None
+
+            # Keep the memo bounded, just in case someone has a huge
+            # number of distinct groups
+            if len(self._groupparsecache) >= 4096:
+                self._groupparsecache.clear()
+            self._groupparsecache[description] = cached
+
+        return dict(cached)
+
     def create_group_description(self, streamprops):
         """
         Converts a dictionary of group or stream properties into a
@@ -428,6 +507,38 @@ class Collection(object):
 
         return []
 
+    def groups_to_labels(self, groups, lookup=True):
+        """
+        Converts a list of view groups into a single list of labels
+        covering every group.
+
+        Group to label conversion works against the in-memory stream
+        hierarchy, so batching the conversion does not change how many
+        NNTSC queries are made -- it simply rolls the per-group calls and
+        the associated error handling into one place for callers that
+        work with entire views.
+
+        Child collections should NOT override this function.
+
+        Parameters:
+          groups -- a list of (group id, group description) tuples
+          lookup -- if False, the streams for each label will not be
+                    looked up. See group_to_labels for details.
+
+        Returns:
+          a list of labels covering every group that could be converted.
+          Groups that could not be converted are logged and skipped.
+        """
+        labellists = []
+        for gid, descr in groups:
+            grouplabels = self.group_to_labels(gid, descr, lookup)
+            if grouplabels is None:
+                log("Unable to convert group %d into stream labels" % (gid))
+                continue
+            labellists.append(grouplabels)
+
+        return list(chain.from_iterable(labellists))
+
     def format_single_data(self, data, detail):
         """
         Modifies a single data point into a suitable format for display on
@@ -518,6 +629,78 @@ class Collection(object):
 
         return
 
+    def update_matrix_groups_bulk(self, cache, sources, destinations,
+            optdict, groups, views, viewmanager, viewstyle):
+        """
+        Finds the groups (and labels and streams) required for every
+        cell of a matrix in a single call.
+
+        Child collections may override this if they can batch the
+        per-cell work, e.g. by resolving all of the cached matrix views
+        with one cache request. The default implementation runs
+        update_matrix_groups for each source/destination pair, spreading
+        the cells across a small thread pool because each one is
+        dominated by cache and database round trips.
+
+        Parameters:
+          cache -- the memcache to use for storing/fetching previously
+                   derived matrix views
+          sources -- the list of sites in the source mesh
+          destinations -- the list of sites in the destination mesh
+          optdict -- a dictionary describing the family, direction and/or
+                     metric to show in each cell
+          groups -- a dictionary containing all groups for the matrix so far
+          views -- a dictionary mapping matrix cells to view ids
+          viewstyle -- the view style to use when creating new groups / views.
+
+        Returns:
+          Nothing, but the groups and views dictionaries are updated as
+          described for update_matrix_groups.
+        """
+
+        pairs = []
+        for source, destination in product(sources, destinations):
+            # A site never tests to itself, so mark the diagonal as
+            # having no view rather than looking its streams up
+            if source == destination:
+                views[(source, destination)] = -1
+                continue
+            pairs.append((source, destination))
+
+        if len(pairs) <= 1:
+            for source, destination in pairs:
+                self.update_matrix_groups(cache, source, destination,
+                        optdict, groups, views, viewmanager, viewstyle)
+            return
+
+        # Each cell works on its own groups / views containers and the
+        # results are merged afterwards in cell order, so the per-cell
+        # implementations don't need to worry about sharing state
+        def _process_cell(pair):
+            source, destination = pair
+            cellgroups = []
+            cellviews = {}
+            self.update_matrix_groups(cache, source, destination,
+                    optdict, cellgroups, cellviews, viewmanager, viewstyle)
+            return cellgroups, cellviews
+
+        pool = self._get_matrix_pool(min(len(pairs), 8))
+        for cellgroups, cellviews in pool.map(_process_cell, pairs):
+            groups.extend(cellgroups)
+            views.update(cellviews)
+
+    def _get_matrix_pool(self, workers):
+        """
+        Returns the shared thread pool used for matrix cell updates,
+        creating it if this is the first matrix request.
+        """
+        if self._matrix_pool is None:
+            self.collock.acquire()
+            if self._matrix_pool is None:
+                self._matrix_pool = ThreadPoolExecutor(max_workers=workers)
+            self.collock.release()
+        return self._matrix_pool
+
     def update_streams(self):
         """
         Fetches new streams from NNTSC if the stream manager has not been
@@ -530,7 +713,15 @@ class Collection(object):
           the current timestamp.
         """
 
-        # XXX Do I need to wrap this in a Lock?
+        # Check the timestamp without taking the lock first -- _getcol
+        # calls this on every public API request and the stream map is
+        # almost always fresh, so don't make those requests contend on
+        # collock just to discover there is nothing to do. A stale read
+        # here is harmless as the locked check below is authoritative.
+        now = time.time()
+        if now < (self.lastchecked + STREAM_CHECK_FREQ):
+            return now
+
         self.collock.acquire()
         now = time.time()
 
@@ -1222,7 +1413,14 @@ class Collection(object):
           does not match the regular expression.
         """
 
-        parts = re.match(regex, description)
+        # Compile each distinct pattern once -- group parsing is a hot
+        # path and the collections only ever use a handful of patterns
+        pattern = self._compiledregexes.get(regex)
+        if pattern is None:
+            pattern = re.compile(regex)
+            self._compiledregexes[regex] = pattern
+
+        parts = pattern.match(description)
         if parts is None:
             log("Group description did not match regex for %s" % \
                     (self.collection_name))
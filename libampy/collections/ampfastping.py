@@ -256,22 +256,22 @@ class AmpFastping(AmpIcmp):
 
         return properties
 
-    def update_matrix_groups(self, cache, source, dest, optdict, groups,
-            views, viewmanager, viewstyle):
+    def _matrix_cell_candidate(self, source, dest, optdict, groups, views,
+            viewstyle):
 
         properties = self._set_all_properties(
                 {"source": source, "destination": dest})
 
         if properties is None:
             views[(source, dest)] = -1
-            return
+            return None
 
         ipv4 = self._matrix_group_streams(properties, 'ipv4', groups)
         ipv6 = self._matrix_group_streams(properties, 'ipv6', groups)
 
         if ipv4 == 0 and ipv6 == 0:
             views[(source, dest)] = -1
-            return
+            return None
 
         if optdict['split'] == "ipv4":
             split = "IPV4"
@@ -285,25 +285,7 @@ class AmpFastping(AmpIcmp):
         cachelabel = "_".join(
                 [viewstyle, self.collection_name, split] + proplist)
 
-        viewid = cache.search_matrix_view(cachelabel)
-        if viewid is not None:
-            views[(source, dest)] = viewid
-            return
-
-        cellgroup = self.create_group_from_list(proplist + [split])
-        if cellgroup is None:
-            log("Failed to create group for %s matrix cell" % (
-                        self.collection_name))
-            return None
-
-        viewid = viewmanager.add_groups_to_view(viewstyle,
-                self.collection_name, 0, [cellgroup])
-        if viewid is None:
-            views[(source, dest)] = -1
-            cache.store_matrix_view(cachelabel, -1, 300)
-        else:
-            views[(source, dest)] = viewid
-            cache.store_matrix_view(cachelabel, viewid, 0)
+        return cachelabel, proplist + [split]
 
     def translate_group(self, groupprops):
         if 'source' not in groupprops:
@@ -28,6 +28,7 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+from itertools import product
 from operator import itemgetter
 from libnntscclient.logger import log
 from libampy.collection import Collection
@@ -156,9 +157,12 @@ class AmpIcmp(Collection):
                     (prop, self.collection_name))
                 return None
 
+        # Normalise the aggregation once up front instead of on every use
+        properties['aggregation'] = properties['aggregation'].upper()
+
         return "FROM %s TO %s OPTION %s %s" % ( \
                 properties['source'], properties['destination'],
-                properties['packet_size'], properties['aggregation'].upper())
+                properties['packet_size'], properties['aggregation'])
 
     def parse_group_description(self, description):
         regex = "FROM (?P<source>[.a-zA-Z0-9_-]+) "
@@ -186,9 +190,17 @@ class AmpIcmp(Collection):
 
         return keydict
 
-    def update_matrix_groups(self, cache, source, dest, optdict, groups,
-            views, viewmanager, viewstyle):
-
+    def _matrix_cell_candidate(self, source, dest, optdict, groups, views,
+            viewstyle):
+        """
+        Performs the stream selection for a single matrix cell, without
+        touching the view cache or the views database.
+
+        Returns a tuple containing the cache label for the cell and the
+        list of group properties needed to create its view. Returns None
+        if the cell has no streams (in which case views is updated to
+        reflect that) or the selection failed.
+        """
         baseprop = {'source': source, 'destination': dest}
 
         sels = self.streammanager.find_selections(baseprop, "", "1", 30000, False)
@@ -203,7 +215,7 @@ class AmpIcmp(Collection):
 
         if sizes == {} or 'items' not in sizes:
             views[(source, dest)] = -1
-            return
+            return None
 
         for size in self.sizepreferences:
             if any(size == found['text'] for found in sizes['items']):
@@ -219,7 +231,7 @@ class AmpIcmp(Collection):
 
         if ipv4 == 0 and ipv6 == 0:
             views[(source, dest)] = -1
-            return
+            return None
 
         if optdict['split'] == "ipv4":
             split = "IPV4"
@@ -228,16 +240,28 @@ class AmpIcmp(Collection):
         else:
             split = "FAMILY"
 
-        cachelabel = "_".join([viewstyle, self.collection_name, source, dest,
-                split, baseprop['packet_size']])
-
-        viewid = cache.search_matrix_view(cachelabel)
-        if viewid is not None:
-            views[(source, dest)] = viewid
-            return
-
-        cellgroup = self.create_group_from_list([source, dest,
-                baseprop['packet_size'], split])
+        cachelabel = "%s_%s_%s_%s_%s_%s" % (viewstyle, self.collection_name,
+                source, dest, split, baseprop['packet_size'])
+
+        return cachelabel, [source, dest, baseprop['packet_size'], split]
+
+    def _matrix_empty_label(self, source, dest, optdict, viewstyle):
+        """
+        Cache label used to remember that a matrix cell had no usable
+        streams. Keyed only on the cell and split -- not on a port or
+        packet size -- so the selection work can be skipped entirely on
+        the next refresh.
+        """
+        return "%s_%s_%s_%s_%s_empty" % (viewstyle, self.collection_name,
+                source, dest, optdict['split'])
+
+    def _matrix_cell_create(self, cache, viewmanager, viewstyle, source,
+            dest, cachelabel, grouplist, views):
+        """
+        Creates the view for a matrix cell that was not present in the
+        view cache and records the outcome in both views and the cache.
+        """
+        cellgroup = self.create_group_from_list(grouplist)
         if cellgroup is None:
             log("Failed to create group for %s matrix cell" % (
                         self.collection_name))
@@ -252,6 +276,82 @@ class AmpIcmp(Collection):
             views[(source, dest)] = viewid
             cache.store_matrix_view(cachelabel, viewid, 0)
 
+    def update_matrix_groups(self, cache, source, dest, optdict, groups,
+            views, viewmanager, viewstyle):
+
+        # If this cell was recently found to have no streams, don't
+        # bother re-running the stream selection for it
+        emptylabel = self._matrix_empty_label(source, dest, optdict,
+                viewstyle)
+        if cache.search_matrix_view(emptylabel) is not None:
+            views[(source, dest)] = -1
+            return
+
+        candidate = self._matrix_cell_candidate(source, dest, optdict,
+                groups, views, viewstyle)
+        if candidate is None:
+            if views.get((source, dest)) == -1:
+                cache.store_matrix_view(emptylabel, -1, 300)
+            return None
+
+        cachelabel, grouplist = candidate
+
+        viewid = cache.search_matrix_view(cachelabel)
+        if viewid is not None:
+            views[(source, dest)] = viewid
+            return
+
+        self._matrix_cell_create(cache, viewmanager, viewstyle, source,
+                dest, cachelabel, grouplist, views)
+
+    def update_matrix_groups_bulk(self, cache, sources, destinations,
+            optdict, groups, views, viewmanager, viewstyle):
+
+        # Cells that recently had no streams are remembered in the cache
+        # under a label that doesn't depend on the selection outcome, so
+        # they can be skipped before any selection work happens
+        emptylabels = {}
+        for source, dest in product(sources, destinations):
+            # A site never tests to itself, so mark the diagonal as
+            # having no view rather than looking its streams up
+            if source == dest:
+                views[(source, dest)] = -1
+                continue
+            emptylabels[(source, dest)] = self._matrix_empty_label(
+                    source, dest, optdict, viewstyle)
+
+        knownempty = cache.search_matrix_views(list(emptylabels.values()))
+
+        # Work out the cache label for every remaining cell, so that all
+        # of the cached view ids can be fetched in one cache operation
+        # rather than one round trip per cell
+        candidates = {}
+        for (source, dest), emptylabel in emptylabels.items():
+            if emptylabel in knownempty:
+                views[(source, dest)] = -1
+                continue
+
+            candidate = self._matrix_cell_candidate(source, dest,
+                    optdict, groups, views, viewstyle)
+            if candidate is None:
+                if views.get((source, dest)) == -1:
+                    cache.store_matrix_view(emptylabel, -1, 300)
+                continue
+
+            candidates[(source, dest)] = candidate
+
+        cached = cache.search_matrix_views(
+                [cand[0] for cand in candidates.values()])
+
+        for (source, dest), (cachelabel, grouplist) in candidates.items():
+            viewid = cached.get(cachelabel)
+            if viewid is not None:
+                views[(source, dest)] = viewid
+                continue
+
+            self._matrix_cell_create(cache, viewmanager, viewstyle, source,
+                    dest, cachelabel, grouplist, views)
+
     def translate_group(self, groupprops):
         if 'source' not in groupprops:
             return None
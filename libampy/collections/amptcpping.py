@@ -28,10 +28,22 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+import re
+
 from libnntscclient.logger import log
 from libampy.collections.ampicmp import AmpIcmp
 
 class AmpTcpping(AmpIcmp):
+
+    # The group description format is fixed, so compile the parsing
+    # regex once at class load rather than on every parse
+    GROUP_DESCRIPTION_RE = re.compile(
+            "FROM (?P<source>[.a-zA-Z0-9_-]+) "
+            "TO (?P<destination>[.a-zA-Z0-9_-]+) "
+            "PORT (?P<port>[0-9]+) "
+            "SIZE (?P<size>[a-zA-Z0-9]+) "
+            "(?P<split>[A-Z0-9]+)")
+
     def __init__(self, colid, viewmanager, nntscconf):
         super(AmpTcpping, self).__init__(colid, viewmanager, nntscconf)
         self.streamproperties = [
@@ -46,6 +58,14 @@ class AmpTcpping(AmpIcmp):
         self.integerproperties = ['port']
         self.portpreferences = [443, 53, 80]
 
+        # Preference tables expressed as value -> rank lookups, so that
+        # matrix cell selection can rank the available options in a
+        # single pass rather than rescanning the preference lists
+        self._port_rank = {port: rank
+                for rank, port in enumerate(self.portpreferences)}
+        self._size_rank = {size: rank
+                for rank, size in enumerate(self.default_packet_sizes)}
+
     def create_group_description(self, properties):
         if 'family' in properties:
             properties['aggregation'] = properties['family'].upper()
@@ -56,21 +76,21 @@ class AmpTcpping(AmpIcmp):
                     (prop, self.collection_name))
                 return None
 
+        # Normalise the aggregation once up front instead of on every use
+        properties['aggregation'] = properties['aggregation'].upper()
+
         return "FROM %s TO %s PORT %s SIZE %s %s" % ( \
                 properties['source'], properties['destination'],
                 properties['port'],
-                properties['packet_size'], properties['aggregation'].upper())
+                properties['packet_size'], properties['aggregation'])
 
     def parse_group_description(self, description):
-        regex = "FROM (?P<source>[.a-zA-Z0-9_-]+) "
-        regex += "TO (?P<destination>[.a-zA-Z0-9_-]+) "
-        regex += "PORT (?P<port>[0-9]+) "
-        regex += "SIZE (?P<size>[a-zA-Z0-9]+) "
-        regex += "(?P<split>[A-Z0-9]+)"
-
-        parts = self._apply_group_regex(regex, description)
+        parts = self.GROUP_DESCRIPTION_RE.match(description)
 
         if parts is None:
+            log("Group description did not match regex for %s" % \
+                    (self.collection_name))
+            log(description)
             return None
 
         if parts.group("split") not in self.splits:
@@ -107,68 +127,46 @@ class AmpTcpping(AmpIcmp):
             'packet_size': groupparams['packet_size']
         }
 
-    def update_matrix_groups(self, cache, source, dest, optdict, groups, views,
-            viewmanager, viewstyle):
+    def _matrix_cell_candidate(self, source, dest, optdict, groups, views,
+            viewstyle):
 
         baseprop = {'source': source, 'destination': dest}
 
-        sels = self.streammanager.find_selections(baseprop, "", "1", 30000, False)
-        if sels is None:
-            return None
-
-        req, ports = sels
-        if req != 'port':
+        # Fetch the available ports and the packet sizes tested to each
+        # of them in a single pass over the stream hierarchy
+        options = self.streammanager.find_selections_multi(baseprop,
+                ['port', 'packet_size'], False)
+        if options is None:
             log("Unable to find suitable ports for %s matrix cell %s to %s" \
                     % (self.collection_name, source, dest))
             return None
 
-        if ports == {} or 'items' not in ports:
+        if options == {}:
             views[(source, dest)] = -1
-            return
-
-        minport = None
-        for port in self.portpreferences:
-            for found in ports['items']:
-                if port == int(found['text']):
-                    baseprop['port'] = port
-                    break
-                if minport is None or int(found['text']) < minport:
-                    minport = int(found['text'])
-
-        if 'port' not in baseprop:
-            # Just use the lowest port number for now
-            baseprop['port'] = minport
-
-        sels = self.streammanager.find_selections(baseprop, "", "1", 30000, False)
-        if sels is None:
             return None
 
-        # Find a suitable packet size, based on our test preferences
-        if sels[0] != 'packet_size':
-            log("Unable to find suitable packet sizes for %s matrix cell %s to %s" \
-                    % (self.collection_name, source, dest))
-            return None
+        # Use the most preferred port that was actually tested to,
+        # otherwise just use the lowest port number for now
+        unranked = len(self.portpreferences)
+        baseprop['port'] = min(options,
+                key=lambda port: (self._port_rank.get(port, unranked), port))
 
-        if sels[1] == {} or 'items' not in sels[1]:
+        # Find a suitable packet size, based on our test preferences
+        sizes = options[baseprop['port']]
+        if sizes == []:
             views[(source, dest)] = -1
-            return
+            return None
 
-        for size in self.default_packet_sizes:
-            if any(size == found['text'] for found in sels[1]['items']):
-                baseprop['packet_size'] = size
-                break
+        preferred = min((size for size in sizes if size in self._size_rank),
+                key=self._size_rank.get, default=None)
+        if preferred is not None:
+            baseprop['packet_size'] = preferred
 
         if 'packet_size' not in baseprop:
-            minsize = 0
-            for size in sels[1]['items']:
-                if size['text'] == "random":
-                    continue
-                try:
-                    if int(size['text']) < minsize or minsize == 0:
-                        minsize = int(size['text'])
-                except TypeError:
-                    # packet size is not an int, so ignore it
-                    pass
+            # Fall back to the smallest numeric packet size; "random" and
+            # any other non-numeric sizes are no use for a matrix cell
+            minsize = min((int(size) for size in sizes
+                    if str(size).isdigit()), default=0)
 
             if minsize == 0:
                 return None
@@ -179,7 +177,7 @@ class AmpTcpping(AmpIcmp):
 
         if ipv4 == 0 and ipv6 == 0:
             views[(source, dest)] = -1
-            return
+            return None
 
         if optdict['split'] == "ipv4":
             split = "IPV4"
@@ -188,29 +186,11 @@ class AmpTcpping(AmpIcmp):
         else:
             split = "FAMILY"
 
-        cachelabel = "_".join([self.collection_name, viewstyle, source, dest,
-                str(baseprop['port']), baseprop['packet_size'], split])
-
-        viewid = cache.search_matrix_view(cachelabel)
-        if viewid is not None:
-            views[(source, dest)] = viewid
-            return
-
-        cellgroup = self.create_group_from_list([source, dest, \
-                baseprop['port'], baseprop['packet_size'], split])
+        cachelabel = "%s_%s_%s_%s_%s_%s_%s" % (self.collection_name,
+                viewstyle, source, dest, baseprop['port'],
+                baseprop['packet_size'], split)
 
-        if cellgroup is None:
-            log("Failed to create group for %s matrix cell" % \
-                    (self.collection_name))
-            return None
-
-        viewid = viewmanager.add_groups_to_view(viewstyle,
-                self.collection_name, 0, [cellgroup])
-        if viewid is None:
-            views[(source, dest)] = -1
-            cache.store_matrix_view(cachelabel, -1, 300)
-        else:
-            views[(source, dest)] = viewid
-            cache.store_matrix_view(cachelabel, viewid, 0)
+        return cachelabel, [source, dest, baseprop['port'],
+                baseprop['packet_size'], split]
 
 # vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
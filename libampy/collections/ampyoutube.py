@@ -186,9 +186,9 @@ class AmpYoutube(Collection):
 
         baselabel = 'group_%s' % (groupid)
 
-        for key, value in groupparams.items():
-            if key in self.integerproperties:
-                groupparams[key] = int(value)
+        for key in self.integerproperties:
+            if key in groupparams:
+                groupparams[key] = int(groupparams[key])
 
         if lookup:
             streams = self.streammanager.find_streams(groupparams)
@@ -49,18 +49,27 @@ class RRDSmokeping(Collection):
 
         self.default_aggregation = "FAMILY"
 
+    # Aggregation tables for each detail level, precomputed so that
+    # detail_columns doesn't rebuild the lists on every data query
+    MATRIX_AGGREGATION = (
+        ["median", "median", "median", "loss", "pingsent", "lossrate"],
+        ["avg", "stddev", "count", "sum", "sum", "stddev"]
+    )
+    BASIC_AGGREGATION = (
+        ["loss", "pingsent", "median"],
+        ["sum", "sum", "avg"]
+    )
+    FULL_AGGREGATION = (
+        ["median", "pings", "loss", "pingsent"],
+        ["avg", "smokearray", "sum", "sum"]
+    )
+
     def detail_columns(self, detail):
         if detail == "matrix":
-            aggcols = ["median", "median", "median", "loss", "pingsent", "lossrate"]
-            aggfuncs = ["avg", "stddev", "count", "sum", "sum", "stddev"]
-        elif detail in ["basic", "spark", "tooltiptext"]:
-            aggcols = ["loss", "pingsent", "median"]
-            aggfuncs = ["sum", "sum", "avg"]
-        else:
-            aggcols = ["median", "pings", "loss", "pingsent"]
-            aggfuncs = ["avg", "smokearray", "sum", "sum"]
-
-        return aggcols, aggfuncs
+            return self.MATRIX_AGGREGATION
+        if detail in ["basic", "spark", "tooltiptext"]:
+            return self.BASIC_AGGREGATION
+        return self.FULL_AGGREGATION
 
     def calculate_binsize(self, start, end, detail):
         if (end - start) / 300.0 < 200:
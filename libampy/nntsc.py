@@ -28,12 +28,80 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+import queue
 import socket
 import time
+from itertools import chain
+from threading import Lock
+
 from libnntscclient.protocol import *
 from libnntscclient.logger import log
 from libnntscclient.nntscclient import NNTSCClient
 
+# Give up on connecting to an exporter after this many attempts --
+# callers treat a failed connection as a failed request, so blocking a
+# web worker indefinitely in the retry loop helps nobody
+NNTSC_CONNECT_ATTEMPTS = 5
+
+# Don't rely on the OS default connect timeout, which can leave a web
+# worker hanging for over a minute if the exporter host is unreachable
+NNTSC_CONNECT_TIMEOUT = 5
+
+# Retries back off exponentially (1, 2, 4, ... seconds) up to this cap
+NNTSC_MAX_BACKOFF = 30
+
+# History responses can run to many megabytes, so ask for a receive
+# buffer well beyond the Linux default to cut down on the number of
+# recv calls needed to drain them (the kernel will clamp this to its
+# configured maximum)
+NNTSC_RCVBUF = 4 * 1024 * 1024
+
+# Maximum number of idle connections to keep around per exporter
+NNTSC_POOL_SIZE = 8
+
+# Idle connections older than this are assumed to have been dropped by
+# the exporter and are discarded rather than reused
+NNTSC_POOL_MAX_IDLE = 300
+
+# Idle NNTSC connections available for reuse, keyed by (host, port).
+# Shared across all NNTSCConnection instances in the process so that
+# concurrent history fetches on different threads can each grab one
+_idlepools = {}
+_idlepoollock = Lock()
+
+# How long to remember the collection list for an exporter. Collections
+# only change when NNTSC itself is reconfigured, so a page load can
+# nearly always be answered without a socket round trip
+NNTSC_COLLECTIONS_TTL = 300
+
+# Recently fetched collection lists, keyed by (host, port)
+_collectionscache = {}
+_collectionslock = Lock()
+
+def invalidate_collections():
+    """
+    Discards all cached collection lists, forcing the next
+    request_collections call to go back to the exporter.
+    """
+    _collectionslock.acquire()
+    _collectionscache.clear()
+    _collectionslock.release()
+
+def _get_idle_pool(host, port):
+    """
+    Fetches (creating if necessary) the idle connection pool for the
+    given NNTSC exporter.
+    """
+    pool = _idlepools.get((host, port))
+    if pool is None:
+        _idlepoollock.acquire()
+        pool = _idlepools.get((host, port))
+        if pool is None:
+            pool = queue.Queue(NNTSC_POOL_SIZE)
+            _idlepools[(host, port)] = pool
+        _idlepoollock.release()
+    return pool
+
 class NNTSCConnection(object):
     """
     Class for querying a NNTSC database.
@@ -92,20 +160,45 @@ class NNTSCConnection(object):
         # If we've already got a connection, just use that
         if self.client is not None:
             return self.client
+
+        # Reuse an idle connection to this exporter if one is available,
+        # saving the TCP handshake and exporter setup costs
+        pool = _get_idle_pool(self.host, self.port)
+        while True:
+            try:
+                idle, idlesince = pool.get_nowait()
+            except queue.Empty:
+                break
+
+            if time.time() - idlesince < NNTSC_POOL_MAX_IDLE and \
+                    self._validate_client(idle):
+                self.client = idle
+                return self.client
+            idle.disconnect()
+
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Requests are small and we always wait for the reply, so
+            # don't let Nagle hold them back -- same setting we use for
+            # the memcached connections
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Set before connecting so the larger window is advertised
+            # during the handshake
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, NNTSC_RCVBUF)
         except socket.error as err:
             log("Failed to create socket: %s" % err)
             return None
 
         attempts = 0
         connected = False
+        sock.settimeout(NNTSC_CONNECT_TIMEOUT)
 
-        # XXX Retry forever or die after a certain number of attempts?
-        while connected is False:
+        while connected is False and attempts < NNTSC_CONNECT_ATTEMPTS:
             if attempts > 0:
-                log("Retrying in 30 seconds (attempt %d)" % (attempts + 1))
-                time.sleep(30)
+                delay = min(NNTSC_MAX_BACKOFF, 2 ** (attempts - 1))
+                log("Retrying in %d seconds (attempt %d)" % (
+                        delay, attempts + 1))
+                time.sleep(delay)
 
             try:
                 sock.connect((self.host, self.port))
@@ -116,17 +209,53 @@ class NNTSCConnection(object):
                 attempts += 1
 
         if not connected:
-            log("Unable to connect to NNTSC after numerous attempts")
+            log("Unable to connect to NNTSC after %d attempts" % (attempts))
             return None
 
+        # Back to blocking mode -- queries can legitimately take longer
+        # than the connect timeout to produce a response
+        sock.settimeout(None)
+
         self.client = NNTSCClient(sock)
         return self.client
 
+    def _validate_client(self, client):
+        """
+        Checks that an idle connection has not failed while sitting in
+        the pool. If the client's socket cannot be inspected, the
+        connection is assumed to be usable.
+        """
+        sock = getattr(client, "sock", None)
+        if sock is None:
+            return True
+        try:
+            return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+        except socket.error:
+            return False
+
     def _disconnect(self):
         if self.client:
             self.client.disconnect()
         self.client = None
 
+    def _release(self):
+        """
+        Returns the current connection to the idle pool for reuse.
+
+        Only call this after a response has been fully consumed, so the
+        next user of the connection starts from a clean protocol state;
+        anything that goes wrong mid-request must use _disconnect
+        instead. If the pool is already full the connection is closed.
+        """
+        if self.client is None:
+            return
+        pool = _get_idle_pool(self.host, self.port)
+        try:
+            pool.put_nowait((self.client, time.time()))
+        except queue.Full:
+            self.client.disconnect()
+        self.client = None
+
     def _get_nntsc_message(self):
         """
         Waits for NNTSC to send a response to a query. Will block until
@@ -160,6 +289,11 @@ class NNTSCConnection(object):
         Returns None if the request fails, otherwise will return a list
         of dictionaries where each dictionary describes a collection.
         """
+        cached = _collectionscache.get((self.host, self.port))
+        if cached is not None and \
+                time.monotonic() - cached[0] < NNTSC_COLLECTIONS_TTL:
+            return list(cached[1])
+
         if self.client is None:
             self._connect()
 
@@ -175,8 +309,13 @@ class NNTSCConnection(object):
             return None
 
         if msg[0] == NNTSC_COLLECTIONS:
-            self._disconnect()
-            return msg[1]['collections']
+            self._release()
+            collections = msg[1]['collections']
+            _collectionslock.acquire()
+            _collectionscache[(self.host, self.port)] = \
+                    (time.monotonic(), collections)
+            _collectionslock.release()
+            return collections
         elif msg[0] == NNTSC_QUERY_CANCELLED:
             log("Request for NNTSC Collections timed out")
         else:
@@ -220,40 +359,39 @@ class NNTSCConnection(object):
 
         if reqtype == NNTSC_REQ_ACTIVE_STREAMS:
             logreq = "active "
+            expected = NNTSC_ACTIVE_STREAMS
         else:
             logreq = ""
+            expected = NNTSC_STREAMS
 
         while 1:
+            # _get_nntsc_message only ever returns a complete message or
+            # None, so there is no partial-parse case to consider here
             msg = self._get_nntsc_message()
             if msg is None:
                 self._disconnect()
                 return None
 
-            # Check if we got a complete parsed message, otherwise read some
-            # more data
-            if msg[0] == -1:
-                continue
+            msgtype, body = msg
 
-            if (msg[0] == NNTSC_STREAMS and reqtype == NNTSC_REQ_STREAMS) or \
-                     (msg[0] == NNTSC_ACTIVE_STREAMS and \
-                     reqtype == NNTSC_REQ_ACTIVE_STREAMS):
-                if msg[1]['collection'] != colid:
+            if msgtype == expected:
+                if body['collection'] != colid:
                     continue
 
-                streams += msg[1]['streams']
-                if msg[1]['more'] is False:
+                streams += body['streams']
+                if body['more'] is False:
                     break
-            elif msg[0] == NNTSC_QUERY_CANCELLED:
+            elif msgtype == NNTSC_QUERY_CANCELLED:
                 log("Query for %sstreams for collection %d timed out" % (logreq, colid))
 
                 self._disconnect()
                 return None
             else:
-                log("Received unexpected response to %sstreams request: %d" % (logreq, msg[0]))
+                log("Received unexpected response to %sstreams request: %d" % (logreq, msgtype))
                 self._disconnect()
                 return None
 
-        self._disconnect()
+        self._release()
         return streams
 
     def request_matrix(self, colid, labels, start, end, aggregators):
@@ -344,27 +482,31 @@ class NNTSCConnection(object):
         data = {}
         count = 0
 
+        # Datapoints arrive in chunks, one label per message. Collect the
+        # chunks for each label and join them once at the end, rather than
+        # repeatedly extending a single ever-growing list
+        chunks = {}
+
         while count < len(labels):
+            # _get_nntsc_message only ever returns a complete message or
+            # None, so there is no partial-parse case to consider here
             msg = self._get_nntsc_message()
             if msg is None:
                 self._disconnect()
                 return None
 
-            # Check if we got a complete parsed message, otherwise read some
-            # more data
-            if msg[0] == -1:
-                continue
+            msgtype, body = msg
 
             # Look out for STREAM packets describing new streams
-            if msg[0] == NNTSC_STREAMS:
+            if msgtype == NNTSC_STREAMS:
                 continue
 
-            if msg[0] == NNTSC_QUERY_CANCELLED:
+            if msgtype == NNTSC_QUERY_CANCELLED:
                 # At least some of the data is missing due to a query timeout
-                if msg[1]['collection'] != colid:
+                if body['collection'] != colid:
                     continue
 
-                for lab in msg[1]['labels']:
+                for lab in body['labels']:
                     if lab not in labels:
                         continue
                     if lab not in data:
@@ -372,19 +514,19 @@ class NNTSCConnection(object):
                         data[lab]["data"] = []
                         data[lab]["timedout"] = []
 
-                    data[lab]['timedout'].append((msg[1]['start'], msg[1]['end']))
-                    if msg[1]['more'] is False:
+                    data[lab]['timedout'].append((body['start'], body['end']))
+                    if body['more'] is False:
                         # Make sure we report some sort of frequency if we
                         # are missing all the data...
                         if "freq" not in data[lab]:
                             data[lab]["freq"] = 60
                         count += 1
 
-            if msg[0] == NNTSC_HISTORY:
+            if msgtype == NNTSC_HISTORY:
                 # Sanity checks
-                if msg[1]['collection'] != colid:
+                if body['collection'] != colid:
                     continue
-                label = msg[1]['streamid']
+                label = body['streamid']
                 if label not in labels:
                     continue
                 if label not in data:
@@ -396,13 +538,17 @@ class NNTSCConnection(object):
                 # it's possible the first few blocks have zero
                 # binsize/frequency if we asked for raw data and there was none
                 # available, so keep trying till we get a useful value
-                if data[label]["freq"] == 0 and msg[1]['binsize'] != None:
-                    data[label]["freq"] = msg[1]['binsize']
-                data[label]["data"] += msg[1]['data']
-                if msg[1]['more'] is False:
+                if data[label]["freq"] == 0 and body['binsize'] != None:
+                    data[label]["freq"] = body['binsize']
+                chunks.setdefault(label, []).append(body['data'])
+                if body['more'] is False:
                     # increment the count of completed labels
                     count += 1
-        self._disconnect()
+
+        for label, received in chunks.items():
+            data[label]["data"] = list(chain.from_iterable(received))
+
+        self._release()
         return data
 
 # vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
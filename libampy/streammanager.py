@@ -28,9 +28,14 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
-import re
+import heapq
+import sys
 from libnntscclient.logger import log
 
+# Selected values arrive from the web as strings, but boolean stream
+# properties are stored in the hierarchy as real booleans
+_BOOL_COERCE = {"true": True, "false": False}
+
 class StreamManager(object):
     """
     Class for managing stream hierarchies.
@@ -55,6 +60,9 @@ class StreamManager(object):
     find_selections:
         Returns all possible values for the next level of the hierarchy, given
         the selections made at earlier levels.
+    find_selections_multi:
+        Returns all possible values for several consecutive hierarchy levels
+        at once, given the selections made at earlier levels.
 
 
     """
@@ -79,6 +87,21 @@ class StreamManager(object):
         self.basedict = {}
         self.streams = {}
 
+        # Memoised find_selections results, invalidated whenever a
+        # stream is added. The same dropdown queries arrive over and
+        # over between stream updates, so this saves re-walking and
+        # re-sorting the hierarchy each time
+        self._selcache = {}
+
+        # Memoised find_stream_properties dicts -- matrix and event
+        # views resolve the same stream ids over and over
+        self._props_cache = {}
+
+        # Memoised find_streams results, invalidated whenever a stream
+        # is added. Matrix refreshes repeat the same searches for every
+        # cell until the next stream update changes the answer
+        self._find_memo = {}
+
     def add_stream(self, streamid, storage, properties):
         """
         Adds a new stream to the existing hierarchy
@@ -101,28 +124,40 @@ class StreamManager(object):
         curr = self.basedict
         key = []
 
+        # This loop runs once per property for every stream we ingest, so
+        # hoist the attribute lookups and the terminal key out of it
+        keylist = self.keylist
+        lastkey = keylist[-1]
+        missing = object()
+
         # Iterate through our nested dictionaries, creating new entries if
         # none exist for the various stream properties. Once we get to the
         # end of the hierarchy we should be pointing at a list of stream
         # ids that match all of the preceding properties.
-        for k in self.keylist:
+        for k in keylist:
             # Make sure all of the expected properties are present
-            if k not in properties:
+            val = properties.get(k, missing)
+            if val is missing:
                 return None
-            val = properties[k]
 
-            if val not in curr:
+            # Values like site names and address families repeat across
+            # thousands of streams; interning them means every level of
+            # the hierarchy (and every stored key tuple) shares a single
+            # string object per distinct value
+            if type(val) is str:
+                val = sys.intern(val)
+
+            nextlevel = curr.get(val)
+            if nextlevel is None:
                 # We're at the end of the hierarchy, so create a new list
                 # instead.
-                if k == self.keylist[-1]:
-                    curr[val] = []
-                else:
-                    curr[val] = {}
+                nextlevel = [] if k is lastkey else {}
+                curr[val] = nextlevel
 
             key.append(val)
 
             # Move down to the next hierarchy level
-            curr = curr[val]
+            curr = nextlevel
 
         # Should have a list at this point, so append our new stream id and
         # any 'extra' data we need to keep here
@@ -132,8 +167,16 @@ class StreamManager(object):
             curr.append(streamid)
 
         # Also update our streamid -> streamprops dictionary so we can
-        # look up streams by id as well.
-        self.streams[streamid] = key, storage
+        # look up streams by id as well. A tuple is enough here and is
+        # noticeably smaller than a list when there are hundreds of
+        # thousands of streams
+        self.streams[streamid] = tuple(key), storage
+
+        # The hierarchy has changed, so any remembered selections or
+        # search results are no longer trustworthy
+        self._selcache.clear()
+        self._find_memo.clear()
+        self._props_cache.pop(streamid, None)
 
         return curr
 
@@ -155,25 +198,23 @@ class StreamManager(object):
         if streamid not in self.streams:
             return None
 
-        return dict(list(zip(self.keylist, self.streams[streamid][0])))
+        cached = self._props_cache.get(streamid)
+        if cached is None:
+            cached = dict(zip(self.keylist, self.streams[streamid][0]))
+            if len(self._props_cache) >= 16384:
+                self._props_cache.clear()
+            self._props_cache[streamid] = cached
+
+        # Callers like to scribble extra keys onto the result, so hand
+        # out a copy rather than the cached dict itself
+        return dict(cached)
 
-    def find_streams(self, properties, searching=None, index=0, found=None):
+    def find_streams(self, properties):
         """
         Finds all streams that match a given set of stream properties.
 
-        Note: this is a recursive function. If you are calling this
-        function, make sure that you do NOT provide values for any parameters
-        other than the 'properties' parameter.
-
         Parameters:
           properties -- a dictionary containing the stream properties
-          searching -- the hierarchy dictionary that is currently being
-                       searched. If None, the function will search at the
-                       top hierarchy level.
-          index -- a number indicating how many recursive calls we have made
-                   thus far.
-          found -- a list containing the stream ids that have been matched
-                   thus far. If None, a new list will be created.
 
         Returns:
             a list of streams that matched the given criteria. If there
@@ -187,52 +228,59 @@ class StreamManager(object):
         at that level will be traversed and searched using the remaining
         properties. This means it is possible to do broad searches, i.e.
         get all of the ICMP streams for a source and destination regardless
-        of the packet_size or address family.
+        of the packet_size or family.
 
         """
 
-        # Initialise our recursive search
-        #
-        # Note that the default found argument should NOT be an empty list
-        # as any changes to found will persist in subsequent calls with
-        # default arguments
-        if searching is None:
-            searching = self.basedict
-
-        if found is None:
-            found = []
-
-        # In this case, we've reached the end of the hierarchy and can just
-        # tack on whatever list of streams is here
-        if index == len(self.keylist):
-            found += searching
-            return found
-
-        key = self.keylist[index]
-
-        if key in properties:
-            # There is a specific value for the current stream property
-            val = properties[key]
-
-            #print key, val
-            #print searching.keys()
+        memokey = tuple(sorted(properties.items()))
+        cached = self._find_memo.get(memokey)
+        if cached is None:
+            cached = list(self._iter_streams(properties))
+            if len(self._find_memo) >= 1024:
+                self._find_memo.clear()
+            self._find_memo[memokey] = cached
 
-            # No entry for this property value in hierarchy, so we can bail
-            if val not in searching:
-                return found
+        # Hand out a copy so callers cannot corrupt the memoised list
+        return list(cached)
 
-            # Recurse down to the next hierarchy level
-            found = self.find_streams(properties, searching[val],
-                    index + 1, found)
-            return found
-
-        # If we get here, the stream property at this level was not in the
-        # provided set of parameters so we will treat it as a wildcard
-        # and traverse all of the entries at this hierarchy level
-        for nextdict in searching.values():
-            found = self.find_streams(properties, nextdict, index + 1, found)
-
-        return found
+    def _iter_streams(self, properties):
+        """
+        Generator backing find_streams, yielding the matching streams
+        one at a time so that callers which only want the first few can
+        stop without walking the rest of the hierarchy.
+        """
+        depth = len(self.keylist)
+
+        # Walk the hierarchy depth-first with an explicit stack -- broad
+        # wildcard searches visit a lot of nodes and a Python call frame
+        # per node adds up
+        stack = [(self.basedict, 0)]
+        while stack:
+            searching, index = stack.pop()
+
+            # We've reached the end of the hierarchy, so can just hand
+            # over whatever list of streams is here
+            if index == depth:
+                yield from searching
+                continue
+
+            key = self.keylist[index]
+
+            if key in properties:
+                # There is a specific value for the current stream
+                # property; if it isn't in the hierarchy we can bail on
+                # this branch entirely
+                val = properties[key]
+                if val in searching:
+                    stack.append((searching[val], index + 1))
+                continue
+
+            # The stream property at this level was not in the provided
+            # set of parameters so we will treat it as a wildcard and
+            # traverse all of the entries at this hierarchy level.
+            # Pushed in reverse so they pop in their original order.
+            for nextdict in reversed(searching.values()):
+                stack.append((nextdict, index + 1))
 
     def find_selections(self, selected, term, pageno, pagesize,
             logmissing=False):
@@ -266,6 +314,14 @@ class StreamManager(object):
         of possible values at a particular level.
         """
 
+        # Check whether we've answered this exact query since the last
+        # stream update. Property keys are unique, so sorting the items
+        # never has to compare the (possibly mixed-type) values
+        cachekey = (tuple(sorted(selected.items())), term, str(pageno),
+                pagesize)
+        if cachekey in self._selcache:
+            return self._selcache[cachekey]
+
         requested = None
         curr = self.basedict
 
@@ -281,10 +337,8 @@ class StreamManager(object):
             val = selected[k]
 
             # Convert boolean strings to actual boolean values if needed
-            if val not in curr and val == "true":
-                val = True
-            if val not in curr and val == "false":
-                val = False
+            if val not in curr:
+                val = _BOOL_COERCE.get(val, val)
 
             # Make sure the selected value for this level is actually valid
             if val not in curr:
@@ -299,30 +353,115 @@ class StreamManager(object):
             # accidentally return the stream id list
             return None, []
 
-        result = list(curr.keys())
-        result.sort()
+        skip = (int(pageno) * pagesize) - pagesize
 
         if term != "":
-            pat = ".*(" + re.escape(term) + ").*"
+            # The term was only ever matched literally (it was escaped
+            # before being fed to the regex engine), so a plain substring
+            # test does the same job without compiling a pattern per call
+            matches = sorted(x for x in curr if term in x)
+            page = matches[skip:skip + pagesize]
+            # Report how many options matched the term, not how many
+            # exist overall, so pagination stops at the right place
+            maxitems = len(matches)
         else:
-            pat = None
-
-        skip = (int(pageno) * pagesize) - pagesize
-        seen = 0
+            # Only the requested page needs to be in order, so find the
+            # smallest skip + pagesize options rather than sorting the
+            # entire level just to throw most of it away
+            page = heapq.nsmallest(skip + pagesize, curr)[skip:]
+            maxitems = len(curr)
 
-        filtered = []
-        for x in result:
-            if not pat or re.search(pat, x) is not None:
-                if seen < skip:
-                    seen += 1
-                    continue
+        filtered = [{'id': x, 'text': x} for x in page]
 
-                filtered.append({'id': x, 'text': x})
-                if len(filtered) >= pagesize:
-                    break
+        res = {'maxitems': maxitems, 'items': filtered}
 
-        res = {'maxitems': len(result), 'items': filtered}
+        if len(self._selcache) >= 1024:
+            self._selcache.clear()
+        self._selcache[cachekey] = (requested, res)
 
         return requested, res
 
+    def find_selections_multi(self, selected, properties, logmissing=False):
+        """
+        Gets all possible values for several consecutive hierarchy levels
+        in a single pass, given a set of selections made at earlier levels.
+
+        This is equivalent to calling find_selections once per requested
+        property for every combination of values, but walks the hierarchy
+        only once. It is mainly useful for matrix cell construction, where
+        the caller wants to choose a preferred value at each of the
+        remaining levels without repeated lookups.
+
+        Parameters:
+          selected -- a dictionary containing all of the currently selected
+                      stream properties.
+          properties -- an ordered list of the stream properties to fetch
+                        values for. These must exactly match the hierarchy
+                        levels immediately below the selected properties.
+          logmissing -- if True, log an error message if a selection option
+                        is not present in the hierarchy.
+
+        Returns:
+          a nested dictionary keyed by the values for the first requested
+          property, where each subsequent level is keyed by the values for
+          the next property. The values at the innermost level are sorted
+          lists of the options for the last requested property. Returns
+          None if a selection is invalid or the requested properties do
+          not line up with the hierarchy.
+        """
+
+        cachekey = (tuple(sorted(selected.items())), tuple(properties),
+                "multi")
+        if cachekey in self._selcache:
+            return self._selcache[cachekey]
+
+        curr = self.basedict
+        index = 0
+
+        # Find the level that our selections take us down to, just like
+        # find_selections does
+        for k in self.keylist:
+            if k not in selected:
+                break
+
+            val = selected[k]
+
+            # Convert boolean strings to actual boolean values if needed
+            if val not in curr:
+                val = _BOOL_COERCE.get(val, val)
+
+            # Make sure the selected value for this level is actually valid
+            if val not in curr:
+                if logmissing:
+                    log("Selected value %s for property %s is not present in the stream manager, invalid selection" % (val, k))
+                return None
+
+            curr = curr[val]
+            index += 1
+
+        # The requested properties must line up with the next levels of
+        # the hierarchy, otherwise the caller has asked for something
+        # this stream manager cannot answer
+        if self.keylist[index:index + len(properties)] != list(properties):
+            return None
+
+        result = self._collect_selections(curr, len(properties))
+
+        if len(self._selcache) >= 1024:
+            self._selcache.clear()
+        self._selcache[cachekey] = result
+
+        return result
+
+    def _collect_selections(self, level, depth):
+        """
+        Recursively gathers the values present at the next 'depth' levels
+        of the hierarchy below the given dictionary.
+        """
+        if depth == 1:
+            return sorted(level.keys())
+
+        return {val: self._collect_selections(nextdict, depth - 1)
+                for val, nextdict in level.items()}
+
 # vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
@@ -78,6 +78,9 @@ class ViewManager(object):
       get_group_id:
         Searches for a group that matches a given description. If one does
         not exist, a new group is created.
+      get_group_ids:
+        Searches for the groups matching a list of descriptions with a
+        single query, creating any groups that do not exist.
       get_view_id
         Searches for a view that contains a given set of groups. If one does
         not exist, a new view is created.
@@ -225,6 +228,64 @@ class ViewManager(object):
         self.dblock.release()
         return group_id
 
+    def get_group_ids(self, collection, descriptions):
+        """
+        Queries the views database for all groups matching a list of
+        descriptions, creating any groups that do not already exist.
+
+        Does the same job as calling get_group_id once per description,
+        but only pays one database round-trip for the lookups and one
+        more for any insertions.
+
+        Parameters:
+          collection -- the collection that the groups belong to
+          descriptions -- a list of strings describing the groups
+
+        Returns:
+          a dictionary mapping each description to the ID number of the
+          matching group, or None if there was a database error.
+        """
+
+        groupids = {}
+        if len(descriptions) == 0:
+            return groupids
+
+        query = """SELECT group_id, group_description FROM groups WHERE
+                collection=%s AND group_description = ANY (%s)"""
+        params = (collection, list(descriptions))
+
+        self.dblock.acquire()
+        if self.db.executequery(query, params) == -1:
+            log("Error while checking which groups exist")
+            self.dblock.release()
+            return None
+
+        for row in self.db.cursor:
+            groupids[row['group_description']] = row['group_id']
+        self.db.closecursor()
+
+        missing = [d for d in descriptions if d not in groupids]
+        if len(missing) > 0:
+            query = """INSERT INTO groups (collection, group_description)
+                    VALUES """ + ", ".join(["(%s, %s)"] * len(missing)) + \
+                    """ RETURNING group_id, group_description"""
+            params = []
+            for d in missing:
+                params.append(collection)
+                params.append(d)
+
+            if self.db.executequery(query, tuple(params)) == -1:
+                log("Error while inserting new groups")
+                self.dblock.release()
+                return None
+
+            for row in self.db.cursor:
+                groupids[row['group_description']] = row['group_id']
+            self.db.closecursor()
+
+        self.dblock.release()
+        return groupids
+
     def get_view_id(self, viewstyle, groups):
         """
         Queries the views database for a view that contains the given
@@ -298,9 +359,9 @@ class ViewManager(object):
         if groups is None:
             return None
 
-        existing = []
+        existing = set()
         for vgs in groups.values():
-            existing += [x[0] for x in vgs]
+            existing.update(x[0] for x in vgs)
 
         for description in descriptions:
 
@@ -309,14 +370,11 @@ class ViewManager(object):
             if groupid is None:
                 return None
 
-            # Always keep our groups in sorted order, as this makes it much
-            # easier to query the views table later on
-            if groupid not in existing:
-                existing.append(groupid)
-                existing.sort()
+            existing.add(groupid)
 
-        # Work out the view id for the new set of groups
-        newview = self.get_view_id(viewstyle, existing)
+        # Always keep our groups in sorted order, as this makes it much
+        # easier to query the views table later on
+        newview = self.get_view_id(viewstyle, sorted(existing))
         if newview is None:
             return None
         return newview